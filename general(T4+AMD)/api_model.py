@@ -3,84 +3,369 @@ import numpy as np
 import os
 import cv2
 import uuid
+import hashlib
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dataclasses import dataclass, replace
+
+WIRE_MAGIC = b"NTDT"
+WIRE_CONTENT_TYPE = "application/x-ntut-detections"
+
+IMAGE_CODECS = {
+    "jpg": lambda quality: [cv2.IMWRITE_JPEG_QUALITY, quality],
+    "webp": lambda quality: [cv2.IMWRITE_WEBP_QUALITY, quality],
+    "png": lambda quality: [cv2.IMWRITE_PNG_COMPRESSION, 3],  # lossless
+}
+
+
+@dataclass
+class Detections:
+    """Detections of one image returned by a remote model, as arrays."""
+
+    xyxy: np.ndarray  # (n, 4) float32 box corners
+    conf: np.ndarray  # (n,) float32 scores
+    cls: np.ndarray  # (n,) int32 class ids
+    names: dict[int, str]
+
+    def __len__(self):
+        return len(self.cls)
+
+    @classmethod
+    def from_summary(cls, items: list[dict]):
+        """Builds the arrays from the JSON summary of older servers."""
+        names = {}
+        for item in items:
+            names.setdefault(item.get("class", len(names)), item["name"])
+        ids = {name: class_id for class_id, name in names.items()}
+        return cls(
+            np.array(
+                [[item["box"][k] for k in ("x1", "y1", "x2", "y2")] for item in items],
+                dtype=np.float32,
+            ).reshape(-1, 4),
+            np.array([item.get("confidence", 1.0) for item in items], np.float32),
+            np.array([ids[item["name"]] for item in items], np.int32),
+            names,
+        )
+
+
+def unpack_detections(payload: bytes) -> list[Detections]:
+    """Decodes the binary detection format of the inference server.
+
+    Layout: b"NTDT", uint32 header length, JSON header with the class "names" and
+    the box "counts" of every image, then the float32 (N, 4) boxes, float32 (N,)
+    scores and int32 (N,) class ids of all images, little endian.
+    """
+    if payload[:4] != WIRE_MAGIC:
+        raise ValueError("Not a detection payload")
+    header_len = int.from_bytes(payload[4:8], "little")
+    header = json.loads(payload[8 : 8 + header_len])
+    names = {int(k): v for k, v in header["names"].items()}
+    counts = header["counts"]
+    if not counts:
+        return []
+    total = sum(counts)
+    offset = 8 + header_len
+    xyxy = np.frombuffer(payload, "<f4", total * 4, offset).reshape(-1, 4)
+    offset += xyxy.nbytes
+    conf = np.frombuffer(payload, "<f4", total, offset)
+    offset += conf.nbytes
+    class_ids = np.frombuffer(payload, "<i4", total, offset)
+    splits = np.cumsum(counts)[:-1]
+    return [
+        Detections(*arrays, names)
+        for arrays in zip(
+            np.split(xyxy, splits), np.split(conf, splits), np.split(class_ids, splits)
+        )
+    ]
+
+
+def _rescale(detections: Detections, scale: float) -> Detections:
+    """Maps boxes found on a resized image back to the original image."""
+    if scale == 1.0:
+        return detections
+    return replace(detections, xyxy=detections.xyxy / np.float32(scale))
+
+
+class _SafeRetry(Retry):
+    """Retries that never hand the server work it may already be doing.
+
+    Idempotent requests are retried on 502, 503 and 504. POSTs, such as batch
+    inference and uploads, are only retried on connection errors and on a 503 with
+    Retry-After, which the server sends when it is overloaded, before queueing
+    anything. Configured with ``read=0``, requests that timed out are not retried.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after=False) -> bool:
+        if not self._is_method_retryable(method):
+            return bool(self.total and has_retry_after and status_code == 503)
+        return super().is_retry(method, status_code, has_retry_after)
 
 
 class APIModel:
-    def __init__(self, ip_address: str, port: int, model_path: str):
+    def __init__(
+        self,
+        ip_address: str,
+        port: int,
+        model_path: str,
+        max_workers: int = 4,
+        timeout: tuple[float, float] = (3.05, 120),
+        retries: int = 3,
+        chunk_size: int = 8 << 20,
+        imgsz: int | None = 640,
+        codec: str = "jpg",
+        quality: int = 90,
+        grayscale: bool = False,
+    ):
+        """Remote model served by the inference server at `ip_address:port`.
+
+        Requests share a pooled keep-alive session. A batch of images is sent in a
+        single request to the batch endpoint, servers without it get up to
+        `max_workers` concurrent single image requests instead. `timeout` is the
+        (connect, read) timeout in seconds and failed requests are retried up to
+        `retries` times, POSTs only if the server has not started on them. The model
+        is only uploaded if the server does not have it yet, in resumable chunks of
+        `chunk_size` bytes.
+
+        Pages are shrunk so that their longest side is `imgsz`, the input size the
+        server resizes to anyway, and boxes are scaled back to page coordinates. They
+        are sent as `codec` ("jpg", "webp" or "png") with the given `quality`, and in
+        grayscale if `grayscale` is set, which suits scanned papers.
+        """
+        if codec not in IMAGE_CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
         self.model_path = model_path
         self.base_url = f"http://{ip_address}:{port}"
         self.host = ip_address
         self.port = port
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.imgsz = imgsz
+        self.codec = codec
+        self.quality = quality
+        self.grayscale = grayscale
+        self.session = requests.Session()
+        retry = _SafeRetry(
+            total=retries,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+        )
+        adapter = HTTPAdapter(pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"api-{port}"
+        )
+        self._model_lock = threading.Lock()
+        self.batch_endpoint = True
+        self.available = True
+
+    def probe(self, timeout: float = 2) -> bool:
+        """Check whether the server is up and ready, updating `available`."""
+        try:
+            response = requests.get(f"{self.base_url}/readyz", timeout=timeout)
+            # Older servers have no readiness route but are up if they answer
+            self.available = response.status_code in (200, 404)
+        except requests.RequestException:
+            self.available = False
+        return self.available
+
+    def _model_hash(self) -> str:
+        digest = hashlib.sha256()
+        with open(self.model_path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     def _upload_model(self):
-        """Upload the model to the API server."""
+        """Upload the model to the API server, unless it already has it.
+
+        The server is asked for the model by its SHA-256 first. On a miss the file
+        is sent in chunks, resuming from whatever the server already received.
+        """
+        model_hash = self._model_hash()
+        url = f"{self.base_url}/upload-model/{model_hash}"
+        response = self.session.get(url, timeout=self.timeout)
+        if response.status_code == 404:
+            # Older servers only take the whole file in one request
+            return self._upload_model_file()
+        if response.status_code != 200:
+            raise Exception(f"Failed to check model: {response.text}")
+        status = response.json()
+        if status["cached"]:
+            return model_hash
+
+        offset = status["offset"]
+        with open(self.model_path, "rb") as f:
+            f.seek(offset)
+            while chunk := f.read(self.chunk_size):
+                response = self.session.put(
+                    url, params={"offset": offset}, data=chunk, timeout=self.timeout
+                )
+                if response.status_code == 409:
+                    # Out of sync with the server, continue from what it has
+                    offset = response.json()["offset"]
+                    f.seek(offset)
+                    continue
+                if response.status_code != 200:
+                    raise Exception(f"Failed to upload model: {response.text}")
+                offset = response.json()["offset"]
+
+        response = self.session.post(
+            f"{url}/complete",
+            params={"filename": os.path.basename(self.model_path)},
+            timeout=self.timeout,
+        )
+        if response.status_code != 200:
+            raise Exception(f"Failed to upload model: {response.text}")
+        return response.json()
+
+    def _upload_model_file(self):
+        """Upload the whole model file to the API server."""
         with open(self.model_path, "rb") as f:
             files = {"file": (os.path.basename(self.model_path), f)}
-            response = requests.post(f"{self.base_url}/upload-model/", files=files)
+            response = self.session.post(
+                f"{self.base_url}/upload-model/", files=files, timeout=self.timeout
+            )
         if response.status_code == 200:
             return response.json()
         else:
             raise Exception(f"Failed to upload model: {response.text}")
 
-    def _upload_image(self, image: np.ndarray | list[np.ndarray]):
-        """Upload the image to the API server."""
+    def _encode_image(self, img: np.ndarray) -> tuple[bytes, float]:
+        """Encode a page for upload, returning the bytes and the resize scale."""
+        scale = 1.0
+        if self.imgsz and max(img.shape[:2]) > self.imgsz:
+            scale = self.imgsz / max(img.shape[:2])
+            size = (round(img.shape[1] * scale), round(img.shape[0] * scale))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        # Pages are rendered as RGB
+        if self.grayscale and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        params = IMAGE_CODECS[self.codec](self.quality)
+        return cv2.imencode(f".{self.codec}", img, params)[1].tobytes(), scale
 
-        def _process_image(img: np.ndarray):
-            """Process the image for upload."""
-            name = f"{uuid.uuid4()}.jpg"
-            files = {"file": (name, cv2.imencode(".jpg", img)[1].tobytes())}
-            response = requests.post(
-                f"{self.base_url}/upload-img/{self.model}", files=files
-            )
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(f"Failed to upload model: {response.text}")
-
-        if isinstance(image, list):
-            results = []
-            for img in image:
-                results.append(_process_image(img))
-            return results
-        elif isinstance(image, np.ndarray):
-            return _process_image(image)
+    def _upload_image(self, data: bytes):
+        """Upload the encoded image to the API server."""
+        name = f"{uuid.uuid4()}.{self.codec}"
+        files = {"file": (name, data)}
+        response = self.session.post(
+            f"{self.base_url}/upload-img/{self.model}",
+            files=files,
+            timeout=self.timeout,
+        )
+        if response.status_code == 200:
+            return response.json()
         else:
-            raise TypeError("Image must be a numpy array or a list of numpy arrays.")
+            raise Exception(f"Failed to upload image: {response.text}")
 
     def _download_file(self, server_file_path: str, basef: str):
         """Download a file from the API server."""
-        response = requests.get(
-            f"{self.base_url}/download-image/{server_file_path}/{basef}", stream=True
+        response = self.session.get(
+            f"{self.base_url}/download-image/{server_file_path}/{basef}",
+            timeout=self.timeout,
         )
         if response.status_code != 200:
             raise Exception(f"Failed to download file: {response.text}")
-        try:
-            image_bytes = b"".join(
-                chunk for chunk in response.iter_content(chunk_size=8192)
-            )
-            return image_bytes
-        except Exception as e:
-            raise Exception(f"Failed to extract bytes: {str(e)}")
+        return response.content
+
+    def _infer(self, img: np.ndarray):
+        """Upload a single image and fetch its detections."""
+        encoded, scale = self._encode_image(img)
+        data = self._upload_image(encoded)
+        summary_file_path = data["summary_file_path"]
+        basef = data["baseF"]
+        result = self._download_file(os.path.basename(summary_file_path), basef)
+        result = result.decode("utf-8").replace("'", '"')
+        return _rescale(Detections.from_summary(json.loads(result)), scale)
+
+    def _infer_batch(self, images: list[np.ndarray]):
+        """Run the model on all images in one request, None if the server lacks it."""
+        encoded = list(self._executor.map(self._encode_image, images))
+        files = [
+            ("files", (f"{i}.{self.codec}", data))
+            for i, (data, _) in enumerate(encoded)
+        ]
+        response = self.session.post(
+            f"{self.base_url}/infer-batch/{self.model}",
+            params={"format": "bin"},
+            files=files,
+            timeout=self.timeout,
+        )
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise Exception(f"Failed to run batch inference: {response.text}")
+        if response.headers.get("content-type", "").startswith(WIRE_CONTENT_TYPE):
+            results = unpack_detections(response.content)
+        else:
+            # Servers without the binary format answer with JSON summaries
+            results = [
+                Detections.from_summary(items) for items in response.json()["results"]
+            ]
+        return [_rescale(det, scale) for det, (_, scale) in zip(results, encoded)]
 
     def __call__(self, image: np.ndarray | list[np.ndarray]):
-        """Call the API with the image data."""
-        if not hasattr(self, "model"):
-            # Upload the model only once
-            self.model = self._upload_model()
-
-        def _get_result(data):
-            summary_file_path = data["summary_file_path"]
-            basef = data["baseF"]
-            result = self._download_file(os.path.basename(summary_file_path), basef)
-            result = result.decode("utf-8").replace("'", '"')
-            return json.loads(result)
-
-        data = self._upload_image(image)
-        if isinstance(data, list):
-            results = []
-            for item in data:
-                results.append(_get_result(item))
-            return results
+        """Call the API with the image data, returning `Detections` per image."""
+        if isinstance(image, np.ndarray):
+            images = [image]
+        elif isinstance(image, list):
+            images = image
         else:
-            return _get_result(data)
+            raise TypeError("Image must be a numpy array or a list of numpy arrays.")
+
+        with self._model_lock:
+            if not hasattr(self, "model"):
+                # Upload the model only once
+                self.model = self._upload_model()
+
+        results = None
+        if self.batch_endpoint:
+            results = self._infer_batch(images)
+            if results is None:
+                # Older servers only have the single image routes
+                self.batch_endpoint = False
+        if results is None:
+            # Results come back in input order
+            results = list(self._executor.map(self._infer, images))
+        return results if isinstance(image, list) else results[0]
+
+
+def watch_remote_models(
+    models: dict, interval: float = 30, timeout: float = 2
+) -> threading.Thread:
+    """Probe all remote models in parallel now, then again every `interval` seconds.
+
+    Each probe updates `APIModel.available`. Models whose server went down are
+    re-admitted as soon as it answers again.
+    """
+    remotes = {name: m for name, m in models.items() if isinstance(m, APIModel)}
+
+    def probe_all():
+        if not remotes:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(remotes)) as pool:
+            states = pool.map(lambda model: model.probe(timeout), remotes.values())
+            return dict(zip(remotes, states))
+
+    for name, available in probe_all().items():
+        if not available:
+            print(f"Model {name} is unavailable.")
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            before = {name: model.available for name, model in remotes.items()}
+            for name, available in probe_all().items():
+                if available != before[name]:
+                    state = "available again" if available else "unavailable"
+                    print(f"Model {name} is {state}.")
+
+    thread = threading.Thread(target=watch, name="remote-probe", daemon=True)
+    thread.start()
+    return thread
@@ -3,7 +3,6 @@ from functools import partial
 import getpass
 import os
 import pandas as pd
-import socket
 
 from paper_store import PaperStore
 from handlers import (
@@ -11,10 +10,24 @@ from handlers import (
     handle_load_initial_search_view,
     handle_search_query,
     handle_display_paper_details,
+    handle_select_paper_image,
     handle_model_test,
+    handle_refresh_models,
+    available_models,
 )
-from constants import MODELS, SEL_PAPER_MSG, CUSTOM_CSS, LABEL_MAP, MODELS_INSTANCES
-from api_model import APIModel
+from constants import (
+    MODELS,
+    SEL_PAPER_MSG,
+    CUSTOM_CSS,
+    LABEL_MAP,
+    MODELS_INSTANCES,
+    REMOTE_PROBE_INTERVAL,
+    PRELOAD_MODELS,
+    PIPELINE_OCR_PROCESSES,
+)
+from api_model import watch_remote_models
+import ocr
+import threading
 
 # Initialize the paper store (a single instance for the app's lifecycle)
 paper_store_instance = PaperStore()
@@ -30,37 +43,14 @@ _handle_search_query = partial(handle_search_query, paper_store=paper_store_inst
 _handle_display_paper_details = partial(
     handle_display_paper_details, paper_store=paper_store_instance
 )
+_handle_select_paper_image = partial(
+    handle_select_paper_image, paper_store=paper_store_instance
+)
 
 
-def test_port(host, port) -> bool:
-    """test if a port is open on a given host"""
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(2)
-            result = s.connect_ex((host, port))
-            if result == 0:
-                print(f"Port {port} is open on {host}")
-            else:
-                print(f"Port {port} is closed on {host}")
-            return result == 0
-    except Exception as e:
-        print(f"Error checking port {port} on {host}: {e}")
-        return False
-
-
-# Remove unavailable models
-remove_models = []
-for model in MODELS:
-    model_instance = MODELS_INSTANCES.get(model)
-    if isinstance(model_instance, APIModel):
-        print(f"Checking availability of model: {model}")
-        if not test_port(model_instance.host, model_instance.port):
-            print(f"Model {model} is unavailable, removing it.")
-            remove_models.append(model)
-for model in remove_models:
-    print(f"Removing unavailable model: {model}")
-    MODELS_INSTANCES.pop(model)
-    MODELS.remove(model)
+# Probe the remote models in parallel, then keep watching them in the background.
+# Models whose server is down are hidden until it answers again.
+watch_remote_models(MODELS_INSTANCES.instances, interval=REMOTE_PROBE_INTERVAL)
 
 with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
     gr.Markdown("# PDF Document Analyzer")
@@ -75,6 +65,13 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
 
         pdf = gr.File(label="Upload PDF", file_types=[".pdf"])
 
+        # Unchecked models are only tested if they are already loaded
+        test_models = gr.CheckboxGroup(
+            label="Models to load",
+            choices=list(MODELS_INSTANCES.factories),
+            value=PRELOAD_MODELS,
+        )
+
         btn = gr.Button("Run Model", variant="primary")
 
         table = gr.DataFrame(pd.DataFrame(data), interactive=False)
@@ -88,23 +85,34 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
 
         btn.click(
             fn=handle_model_test,
-            inputs=[pdf, table],
+            inputs=[pdf, table, test_models],
             outputs=[table, gallary],
         )
 
     with gr.Tab("Upload and Analyze") as upload_tab:
-        model_choice = gr.Radio(label="Select Model", choices=MODELS, value=MODELS[0])
+        model_choices = available_models()
+        model_choice = gr.Radio(
+            label="Select Model",
+            choices=model_choices,
+            value=model_choices[0] if model_choices else None,
+        )
         pdf_upload = gr.File(
             label="Upload PDF(s)", file_types=[".pdf"], file_count="multiple"
         )
+        reprocess_checkbox = gr.Checkbox(
+            label="Re-process papers that are already stored", value=False
+        )
         run_button = gr.Button("Run Analysis", variant="primary")
         status_log = gr.Textbox(label="Status Log", lines=8, interactive=False)
         run_button.click(
             fn=_handle_pdf_processing,
-            inputs=[model_choice, pdf_upload],
+            inputs=[model_choice, pdf_upload, reprocess_checkbox],
             outputs=[status_log, pdf_upload],
             show_progress="full",
         )
+        upload_tab.select(
+            fn=handle_refresh_models, inputs=[model_choice], outputs=[model_choice]
+        )
     with gr.Tab("Search and View") as search_tab:
         with gr.Column():
             with gr.Row(elem_id="search-bar-container"):
@@ -139,6 +147,10 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
                         height="auto",
                         elem_id="image-gallery-component",
                     )
+                    full_image = gr.Image(
+                        label="Selected image (full resolution)",
+                        interactive=False,
+                    )
 
         search_outputs = [paper_radio, paper_desc, image_gallery]
         search_button.click(
@@ -150,9 +162,14 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
         paper_radio.change(
             fn=_handle_display_paper_details,
             inputs=[paper_radio],
-            outputs=[paper_desc, image_gallery],
+            outputs=[paper_desc, image_gallery, full_image],
             show_progress="full",
         )
+        image_gallery.select(
+            fn=_handle_select_paper_image,
+            inputs=[paper_radio],
+            outputs=[full_image],
+        )
         search_tab.select(
             fn=_handle_load_initial_search_view,
             inputs=None,
@@ -168,4 +185,13 @@ if __name__ == "__main__":
         os.environ["GOOGLE_API_KEY"] = getpass.getpass(
             "Enter your Gemini API key (will not be stored): "
         )
+    # Local models and the OCR readers are loaded lazily, warm them up in the
+    # background so the UI is served right away.
+    MODELS_INSTANCES.preload(PRELOAD_MODELS)
+    threading.Thread(
+        target=ocr.warm_up,
+        args=(PIPELINE_OCR_PROCESSES,),
+        name="ocr-preload",
+        daemon=True,
+    ).start()
     app.launch(debug=True)
@@ -0,0 +1,116 @@
+import importlib.util
+import os
+from typing import Type
+
+from ultralytics import RTDETR
+
+# Runtimes tried in order on hosts without a GPU, the first installed one is used.
+CPU_BACKENDS = ["openvino", "onnx", "tflite"]
+BACKENDS = ["torch"] + CPU_BACKENDS
+# Python modules that provide each runtime, any of them is enough.
+RUNTIME_MODULES = {
+    "openvino": ["openvino"],
+    "onnx": ["onnxruntime"],
+    "tflite": ["ai_edge_litert", "tflite_runtime", "tensorflow"],
+}
+
+
+def runtime_available(backend: str) -> bool:
+    """Whether the runtime of the backend can be imported on this host."""
+    if backend == "torch":
+        return True
+    return any(
+        importlib.util.find_spec(module) is not None
+        for module in RUNTIME_MODULES[backend]
+    )
+
+
+def best_backend() -> str:
+    """Picks the fastest available backend: PyTorch on a GPU, otherwise the first
+    installed CPU runtime, falling back to PyTorch."""
+    import torch
+
+    if torch.cuda.is_available():
+        return "torch"
+    for backend in CPU_BACKENDS:
+        if runtime_available(backend):
+            return backend
+    return "torch"
+
+
+def artifact_path(model_path: str, backend: str, int8: bool = False) -> str:
+    """Where the ultralytics exporter writes the model for the backend."""
+    stem, _ = os.path.splitext(model_path)
+    name = os.path.basename(stem)
+    if backend == "onnx":
+        return f"{stem}.onnx"
+    if backend == "openvino":
+        return f"{stem}_openvino_model"
+    if backend == "tflite":
+        precision = "int8" if int8 else "float16"
+        return os.path.join(f"{stem}_saved_model", f"{name}_{precision}.tflite")
+    return model_path
+
+
+def export_model(
+    model_cls: Type, model_path: str, backend: str, imgsz: int = 640, data=None
+) -> str:
+    """Exports the model for the backend next to the `.pt` and returns its path.
+
+    The export is reused as long as it is newer than the `.pt`. ONNX and OpenVINO
+    models keep a dynamic batch size. TFLite models take one image at a time and
+    are float16, or int8 quantized if `data` names a dataset YAML to calibrate on,
+    which should hold document pages rather than the ultralytics default (COCO).
+    """
+    int8 = backend == "tflite" and data is not None
+    path = artifact_path(model_path, backend, int8)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model_path):
+        return path
+    print(f"Exporting {model_path} to {backend}")
+    kwargs = {"imgsz": imgsz}
+    if backend in ("onnx", "openvino"):
+        kwargs["dynamic"] = True
+    elif int8:
+        kwargs["int8"] = True
+        kwargs["data"] = data
+    elif backend == "tflite":
+        kwargs["half"] = True
+    model_cls(model_path).export(format=backend, **kwargs)
+    return path
+
+
+def load_model(
+    model_cls: Type,
+    model_path: str,
+    backend: str = "auto",
+    imgsz: int = 640,
+    data=None,
+):
+    """Loads a `.pt` model with the given backend, "auto" picks the best one.
+
+    Exported models are still ultralytics models, so they return the same results
+    with the same class names. If the export fails the `.pt` model is used. `data`
+    is the calibration dataset of int8 TFLite exports, see `export_model`.
+    """
+    if backend == "auto":
+        backend = best_backend()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if backend == "torch":
+        return model_cls(model_path)
+    try:
+        path = export_model(model_cls, model_path, backend, imgsz, data)
+    except Exception as e:
+        print(f"Failed to export {model_path} to {backend}, using PyTorch: {e}")
+        return model_cls(model_path)
+    if model_cls is RTDETR:
+        return RTDETR(path)
+    return model_cls(path, task="detect")
+
+
+def single_image(model_instance) -> bool:
+    """Whether the model only takes one image per call, as TFLite models do."""
+    if hasattr(model_instance, "interpreter"):
+        return True
+    model = getattr(model_instance, "model", None)
+    return isinstance(model, str) and model.endswith(".tflite")
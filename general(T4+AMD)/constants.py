@@ -1,5 +1,9 @@
+import os
+from functools import partial
 from ultralytics import YOLO, RTDETR
 from api_model import APIModel
+from model_registry import ModelRegistry
+from backends import load_model
 
 MODELS = [
     "YOLO-plain",
@@ -14,20 +18,94 @@ MODELS = [
 NO_RES_ID = "NO_RES_ID"
 NO_RES_MSG = "No papers found matching the search query."
 SEL_PAPER_MSG = "Please select a paper to view details."
-MODELS_INSTANCES = {
-    "YOLO-plain": YOLO("models/YOLO-plain.pt"),
-    "YOLO-large_batch": YOLO("models/YOLO-large_batch.pt"),
-    "YOLO-adam_optimizer": YOLO("models/YOLO-adam_optimizer.pt"),
-    "RTDETR": RTDETR("models/RTDETR.pt"),
-    "YOLO-plain-remote": APIModel("140.124.181.195", 8010, "models/YOLO-plain.pt"),
-    "YOLO-large_batch-remote": APIModel(
-        "140.124.181.195", 8010, "models/YOLO-large_batch.pt"
-    ),
-    "YOLO-adam_optimizer-remote": APIModel(
-        "140.124.181.195", 8010, "models/YOLO-adam_optimizer.pt"
-    ),
-    "RTDETR-remote": APIModel("140.124.181.195", 8080, "models/RTDETR.pt"),
+# Local models are loaded on first use, at most MAX_LOADED_MODELS stay in memory.
+# Remote models hold no weights and are created up front.
+MAX_LOADED_MODELS = 2
+# Runtime of the local models: "auto" uses PyTorch on a GPU and otherwise the first
+# installed of OpenVINO, ONNX Runtime and TFLite. Exports are cached next to the .pt
+# files. One of "auto", "torch", "openvino", "onnx" or "tflite".
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "auto")
+# TFLite exports are float16. Set to a dataset YAML of document pages to export int8
+# models calibrated on them instead.
+TFLITE_CALIBRATION_DATA = os.getenv("TFLITE_CALIBRATION_DATA")
+# Inference server of the remote models, see server/ntut_vm_server.py. It serves
+# on 8070 unless started with another PORT.
+REMOTE_HOST = os.getenv("REMOTE_HOST", "140.124.181.195")
+REMOTE_PORT = int(os.getenv("REMOTE_PORT", "8070"))
+MODELS_INSTANCES = ModelRegistry(
+    {
+        "YOLO-plain": partial(
+            load_model,
+            YOLO,
+            "models/YOLO-plain.pt",
+            backend=MODEL_BACKEND,
+            data=TFLITE_CALIBRATION_DATA,
+        ),
+        "YOLO-large_batch": partial(
+            load_model,
+            YOLO,
+            "models/YOLO-large_batch.pt",
+            backend=MODEL_BACKEND,
+            data=TFLITE_CALIBRATION_DATA,
+        ),
+        "YOLO-adam_optimizer": partial(
+            load_model,
+            YOLO,
+            "models/YOLO-adam_optimizer.pt",
+            backend=MODEL_BACKEND,
+            data=TFLITE_CALIBRATION_DATA,
+        ),
+        "RTDETR": partial(
+            load_model,
+            RTDETR,
+            "models/RTDETR.pt",
+            backend=MODEL_BACKEND,
+            data=TFLITE_CALIBRATION_DATA,
+        ),
+    },
+    instances={
+        "YOLO-plain-remote": APIModel(REMOTE_HOST, REMOTE_PORT, "models/YOLO-plain.pt"),
+        "YOLO-large_batch-remote": APIModel(
+            REMOTE_HOST, REMOTE_PORT, "models/YOLO-large_batch.pt"
+        ),
+        "YOLO-adam_optimizer-remote": APIModel(
+            REMOTE_HOST, REMOTE_PORT, "models/YOLO-adam_optimizer.pt"
+        ),
+        "RTDETR-remote": APIModel(REMOTE_HOST, REMOTE_PORT, "models/RTDETR.pt"),
+    },
+    max_loaded=MAX_LOADED_MODELS,
+)
+# Models loaded in the background once the UI is up.
+PRELOAD_MODELS = ["YOLO-plain"]
+# Seconds between availability probes of the remote models
+REMOTE_PROBE_INTERVAL = 30
+# Number of pages passed to each model per call when processing PDFs.
+MODELS_BATCH_SIZES = {
+    "YOLO-plain": 16,
+    "YOLO-large_batch": 16,
+    "YOLO-adam_optimizer": 16,
+    "RTDETR": 8,
+    "YOLO-plain-remote": 8,
+    "YOLO-large_batch-remote": 8,
+    "YOLO-adam_optimizer-remote": 8,
+    "RTDETR-remote": 8,
 }
+DEFAULT_BATCH_SIZE = 8
+# Worker processes used to rasterize PDF pages, 1 renders in-process.
+RASTER_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+# Ingestion pipeline limits: papers rasterized at once, OCR threads, concurrent
+# Gemini requests, size of the queues between stages and pages buffered per paper.
+PIPELINE_PAPERS_IN_FLIGHT = 2
+PIPELINE_OCR_WORKERS = 2
+PIPELINE_LLM_CONCURRENCY = 4
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_PAGE_BUFFER = 2 * DEFAULT_BATCH_SIZE
+# Processes that run OCR, each with its own EasyOCR reader (several hundred MB),
+# 1 runs in-process.
+PIPELINE_OCR_PROCESSES = min(2, os.cpu_count() or 1)
+# Take the text of title and chapter boxes from the PDF text layer when there is
+# one, and only OCR the boxes without embedded text.
+TEXT_LAYER_FIRST = True
 CUSTOM_CSS = """
 #search-bar-container > .gr-form {
     display: flex;
@@ -90,6 +168,9 @@ Title: {{TITLE}}
 Chapters: {{CHAPTERS}}
 Context of the paper: {{CONTEXT}}
 """
+KEYWORDS_PROMPT = """Extract keywords from the following text in a comma-separated format, please do not include any additional text or formatting:
+
+text: {{TEXT}}"""
 
 
 LABEL_MAP = {
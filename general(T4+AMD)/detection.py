@@ -0,0 +1,86 @@
+import itertools
+from typing import Any, Iterable, Iterator, Tuple
+import numpy as np
+
+from constants import MODELS_BATCH_SIZES, DEFAULT_BATCH_SIZE
+from backends import single_image
+from api_model import Detections
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    """Yields successive lists of at most `size` items."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def run_detection(
+    model_name: str, model_instance, images: Iterable[np.ndarray]
+) -> Iterator[Tuple[np.ndarray, Any]]:
+    """Runs the model over the pages in batches and yields (page, result) pairs."""
+    batch_size = MODELS_BATCH_SIZES.get(model_name, DEFAULT_BATCH_SIZE)
+    if single_image(model_instance):
+        batch_size = 1
+    for batch in batched(images, batch_size):
+        yield from zip(batch, model_instance(batch))
+
+
+def box_arrays(result) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """Returns the (class ids, integer xyxy boxes, class names) of a page result."""
+    if isinstance(result, Detections):
+        return result.cls, result.xyxy.astype(int), result.names
+    boxes = result.boxes
+    return (
+        boxes.cls.cpu().numpy().astype(int),
+        boxes.xyxy.cpu().numpy().astype(int),
+        result.names,
+    )
+
+
+def detections(model_instance, result) -> Iterator[Tuple[str, int, int, int, int]]:
+    """Yields (class name, x1, y1, x2, y2) for every box of a single page result."""
+    class_ids, xyxy, names = box_arrays(result)
+    for class_id, (x1, y1, x2, y2) in zip(class_ids.tolist(), xyxy.tolist()):
+        yield names[class_id], x1, y1, x2, y2
+
+
+def page_detections(
+    model_name: str, model_instance, images: Iterable[np.ndarray]
+) -> Iterator[Tuple[np.ndarray, list]]:
+    """Runs the model over the pages and yields each page with its list of boxes."""
+    for img, result in run_detection(model_name, model_instance, images):
+        yield img, list(detections(model_instance, result))
+
+
+def crop_detections(
+    pages: Iterable[Tuple[np.ndarray, list]],
+) -> Tuple[list, list, list]:
+    """Crops the boxes of each page and returns the (figures, titles, chapters)."""
+    figures = []
+    titles = []
+    chapters = []
+    for img, boxes in pages:
+        for name, x1, y1, x2, y2 in boxes:
+            # copy the crop so the full page can be freed
+            cropped_image = img[y1:y2, x1:x2].copy()
+            if name == "fig" or name == "table":
+                figures.append(cropped_image)
+            elif name == "title":
+                titles.append(cropped_image)
+            elif name == "chapter":
+                chapters.append(cropped_image)
+    return figures, titles, chapters
+
+
+def text_boxes(pages_boxes: Iterable[list]) -> Tuple[list, list]:
+    """Returns the (page number, x1, y1, x2, y2) of the title and chapter boxes, in
+    the order of the crops returned by `crop_detections`."""
+    titles = []
+    chapters = []
+    for page_num, boxes in enumerate(pages_boxes):
+        for name, x1, y1, x2, y2 in boxes:
+            if name == "title":
+                titles.append((page_num, x1, y1, x2, y2))
+            elif name == "chapter":
+                chapters.append((page_num, x1, y1, x2, y2))
+    return titles, chapters
@@ -0,0 +1,146 @@
+import mmap
+import threading
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional
+import fitz
+import numpy as np
+
+import pdf2image
+
+# Rendered pages kept per document, the least recently used ones are dropped.
+PAGE_IMAGE_CACHE = 8
+
+
+class PDFDocument:
+    """A PDF that is opened and parsed once, then shared by every ingestion stage.
+
+    The file is memory-mapped and parsed by PyMuPDF a single time. Page images,
+    page text and the text of clipped regions are computed on first use and cached
+    per page. Only the `max_images` most recently used page images are kept, since
+    a rendered page takes several MB. Coordinates of regions are pixels of the
+    images rendered with `zoom_x` and `zoom_y`.
+    """
+
+    def __init__(
+        self, path: str, zoom_x=2, zoom_y=2, max_images: int = PAGE_IMAGE_CACHE
+    ):
+        self.path = path
+        self.zoom_x = zoom_x
+        self.zoom_y = zoom_y
+        self.max_images = max_images
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        try:
+            self._doc = fitz.open(stream=self._view, filetype="pdf")
+        except Exception:
+            self._view.release()
+            self._mmap.close()
+            raise
+        self._matrix = fitz.Matrix(zoom_x, zoom_y)
+        self._pages = {}
+        self._images = OrderedDict()  # page number -> image, least recently used first
+        self._texts = {}
+        self._clips = {}
+        # PyMuPDF documents must not be used from several threads at once.
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._doc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._doc is None:
+                return
+            self._pages.clear()
+            self._images.clear()
+            self._doc.close()
+            self._doc = None
+            self._view.release()
+            self._mmap.close()
+
+    def _page(self, page_num: int):
+        if page_num not in self._pages:
+            self._pages[page_num] = self._doc.load_page(page_num)
+        return self._pages[page_num]
+
+    def page_image(self, page_num: int) -> np.ndarray:
+        """Returns the page rendered to an RGB image, shared by all callers."""
+        with self._lock:
+            image = self._images.get(page_num)
+            if image is None:
+                image = pdf2image.render_page(self._page(page_num), self._matrix)
+                self._images[page_num] = image
+                while len(self._images) > self.max_images:
+                    self._images.popitem(last=False)
+            self._images.move_to_end(page_num)
+            return image
+
+    def iter_images(
+        self, start: int = 0, stop: Optional[int] = None, workers: int = 1
+    ) -> Iterator[np.ndarray]:
+        """Yields the page images in order, see `pdf2image.iter_pdf_pages`.
+
+        With ``workers > 1`` pages are rendered by worker processes, which open the
+        file themselves, and are not cached. Ranges that fit in a single shard are
+        rendered here, from the already open document.
+        """
+        page_count = len(self)
+        stop = page_count if stop is None else min(stop, page_count)
+        if workers > 1 and stop - start > pdf2image.SHARD_PAGES:
+            yield from pdf2image.iter_pdf_pages(
+                self.path, self.zoom_x, self.zoom_y, start, stop, workers, page_count
+            )
+            return
+        for page_num in range(start, stop):
+            yield self.page_image(page_num)
+
+    def page_text(self, page_num: int) -> str:
+        """Returns the text embedded in the page."""
+        with self._lock:
+            text = self._texts.get(page_num)
+            if text is None:
+                text = self._texts[page_num] = self._page(page_num).get_text("text")
+            return text
+
+    def text(self, sep: str = " ") -> str:
+        """Returns the text embedded in all pages."""
+        return sep.join(self.page_text(page_num) for page_num in range(len(self)))
+
+    def clip_text(self, page_num: int, x1, y1, x2, y2) -> str:
+        """Extracts the embedded text inside a box drawn on a rendered page.
+
+        The box is mapped back to PDF coordinates by dividing by the zoom and, as
+        pages are rendered rotated by their /Rotate, undoing the rotation. Boxes
+        without embedded text, e.g. on scanned pages, give an empty string.
+        """
+        key = (page_num, x1, y1, x2, y2)
+        with self._lock:
+            text = self._clips.get(key)
+            if text is None:
+                page = self._page(page_num)
+                clip = (
+                    fitz.Rect(
+                        x1 / self.zoom_x,
+                        y1 / self.zoom_y,
+                        x2 / self.zoom_x,
+                        y2 / self.zoom_y,
+                    )
+                    * page.derotation_matrix
+                )
+                text = " ".join(page.get_text("text", clip=clip).split())
+                # Fonts without a unicode mapping extract as placeholder characters
+                if not any(c.isalnum() for c in text):
+                    text = ""
+                self._clips[key] = text
+            return text
+
+    def boxes_text(self, boxes: Iterable[tuple]) -> list[str]:
+        """Returns `clip_text` of each ``(page number, x1, y1, x2, y2)`` box."""
+        return [self.clip_text(*box) for box in boxes]
@@ -3,22 +3,22 @@ import time
 import os
 from typing import List, Tuple, Optional
 import numpy as np
-import pypdf
 import cv2
 from ultralytics import YOLO, RTDETR
 
 from paper_store import PaperStore
 from constants import (
-    PROMPT,
+    MODELS,
     MODELS_INSTANCES,
     NO_RES_ID,
     NO_RES_MSG,
     SEL_PAPER_MSG,
     LABEL_MAP,
+    RASTER_WORKERS,
 )
-import pdf2image
-import ocr
-import gemini
+from document import PDFDocument
+from detection import run_detection, detections, box_arrays
+from pipeline import IngestPipeline, PaperJob, file_sha256
 from api_model import APIModel
 
 
@@ -34,110 +34,96 @@ def _create_ui_updates(
     return gr.update(choices=choices, value=sel_id), desc_text, imgs
 
 
+def available_models() -> List[str]:
+    """Models that can be used now, remote ones only while their server is up."""
+    return [
+        model
+        for model in MODELS
+        if getattr(MODELS_INSTANCES.peek(model), "available", True)
+    ]
+
+
+def handle_refresh_models(current: Optional[str]):
+    """Updates the model choices with the models that are currently available."""
+    choices = available_models()
+    if current not in choices:
+        current = choices[0] if choices else None
+    return gr.update(choices=choices, value=current)
+
+
 def handle_pdf_processing(
-    model: str, pdf_files: Optional[list], paper_store: PaperStore
+    model: str,
+    pdf_files: Optional[list],
+    reprocess: bool,
+    paper_store: PaperStore,
 ):
-    """Processes uploaded PDF files, updates the paper store, and returns logs."""
+    """Processes uploaded PDF files, updates the paper store, and streams logs.
+
+    Papers are identified by the hash of their content. Papers that are already
+    stored are skipped unless `reprocess` is set, in which case they are processed
+    again from scratch, ignoring cached results, and replaced.
+    Papers run concurrently through the ingestion pipeline, the status log is
+    updated as each of them progresses.
+    """
     if not pdf_files:
-        return "No PDFs provided for processing.", gr.update(value=None)
+        yield "No PDFs provided for processing.", gr.update(value=None)
+        return
+    if not getattr(MODELS_INSTANCES.peek(model), "available", True):
+        yield f"Model {model} is currently unavailable.", gr.update()
+        return
 
     logs = []
-    temp_files_to_clean = []
+    jobs = []
+    seen = set()
 
     for pdf_obj in pdf_files:
-        temp_files_to_clean.append(pdf_obj.name)
         filename = getattr(pdf_obj, "orig_name", os.path.basename(pdf_obj.name))
-        existing_id = paper_store.find_paper_id_by_title(filename)
+        content_hash = file_sha256(pdf_obj.name)
+        existing_id = paper_store.find_paper_id_by_hash(content_hash)
 
-        if existing_id:
+        if content_hash in seen:
+            logs.append(f"Paper '{filename}' was uploaded twice. Skipping the copy.")
+        elif existing_id and not reprocess:
             logs.append(
                 f"Paper '{filename}' already exists with ID: {existing_id}. Skipping reprocessing."
             )
         else:
-
-            # process the PDF file
-            images = pdf2image.pdf_to_images(pdf_obj.name)
-
-            # use YOLO or RTDETR model for object detection
-            model_instance = MODELS_INSTANCES[model]
-            figures = []
-            titles = []
-            chapters = []
-            for img in images:
-                results = model_instance(img)
-                if isinstance(model_instance, YOLO) or isinstance(
-                    model_instance, RTDETR
-                ):
-                    for result in results:
-                        boxes = result.boxes
-                        for box in boxes:
-                            class_id = int(box.cls[0])
-                            xyxy = box.xyxy[0].cpu().numpy()
-                            x1, y1, x2, y2 = map(int, xyxy)
-                            cropped_image = img[y1:y2, x1:x2]
-                            if (
-                                model_instance.names[class_id] == "fig"
-                                or model_instance.names[class_id] == "table"
-                            ):
-                                figures.append(cropped_image)
-                            elif model_instance.names[class_id] == "title":
-                                titles.append(cropped_image)
-                            elif model_instance.names[class_id] == "chapter":
-                                chapters.append(cropped_image)
-
-                if isinstance(model_instance, APIModel):
-                    for result in results:
-                        box = result["box"]
-                        name = result["name"]
-                        x1 = int(box["x1"])
-                        y1 = int(box["y1"])
-                        x2 = int(box["x2"])
-                        y2 = int(box["y2"])
-                        cropped_image = img[y1:y2, x1:x2]
-                        if name == "fig" or name == "table":
-                            figures.append(cropped_image)
-                        elif name == "title":
-                            titles.append(cropped_image)
-                        elif name == "chapter":
-                            chapters.append(cropped_image)
-
-            # Perform OCR on the title and chapter images
-            title_texts = [ocr.ocr_image(title) for title in titles]
-            chapter_texts = [ocr.ocr_image(chapter) for chapter in chapters]
-
-            # Combine all texts for context
-            reader = pypdf.PdfReader(pdf_obj.name)
-            texts = [reader.pages[i].extract_text() for i in range(len(reader.pages))]
-            combined_text = " ".join(texts)
-            generated_text = gemini.generate_text(
-                PROMPT.replace("{{CONTEXT}}", combined_text)
-                .replace("{{TITLE}}", " ".join(title_texts))
-                .replace("{{CHAPTERS}}", " ".join(chapter_texts)),
-            )
-
-            # get keywords from the generated text
-            generated_keywords = gemini.generate_text(
-                "Extract keywords from the following text in a comma-separated format, please do not include any additional text or formatting:\n\n"
-                f"text: {generated_text}",
+            seen.add(content_hash)
+            legacy_id = (
+                None if existing_id else paper_store.find_legacy_paper_id(filename)
             )
-            # Clean up the keywords
-            keywords = [
-                kw.strip() for kw in generated_keywords.split(",") if kw.strip()
-            ]
-            logs.append(f"Extracted keywords: {', '.join(keywords)}")
-
+            if legacy_id:
+                logs.append(
+                    f"Paper '{filename}' has the same title as paper ID {legacy_id}, "
+                    "which was stored without a content hash. It may be a duplicate, "
+                    "processing it as a new paper."
+                )
+            jobs.append(PaperJob(filename, pdf_obj.name, content_hash, existing_id))
+
+    ingest = IngestPipeline(model, paper_store, refresh=reprocess)
+    for event, job, payload in ingest.run(jobs):
+        if event == "log":
+            logs.append(payload)
+        elif event == "error":
+            logs.append(f"Failed to process '{job.filename}': {payload}")
+        elif event == "done":
+            logs.append(f"Extracted keywords: {', '.join(job.keywords)}")
+            # The stored paper is replaced atomically, a failed insert keeps it.
             paper_id = paper_store.add_paper(
-                filename,
-                generated_text,
-                figures,
-                keywords,
+                job.filename,
+                job.desc,
+                job.figures,
+                job.keywords,
+                job.content_hash,
+                replaces=job.replaces,
             )
             logs.append(
-                f"Processed '{filename}' with model '{model}'. Added to store with ID: {paper_id}."
+                f"Processed '{job.filename}' with model '{model}'. Added to store with ID: {paper_id}."
             )
+        yield "\n".join(logs), gr.update()
 
     # After processing, the file input should be cleared
-    return "\n".join(logs), gr.update(value=None)
+    yield "\n".join(logs), gr.update(value=None)
 
 
 def handle_load_initial_search_view(paper_store: PaperStore):
@@ -163,22 +149,37 @@ def handle_search_query(keyword: str, paper_store: PaperStore):
 
 
 def handle_display_paper_details(paper_id: Optional[str], paper_store: PaperStore):
-    """Displays details (description and images) for the selected paper."""
+    """Displays details (description and images) for the selected paper.
+
+    The description is shown right away and the image thumbnails are streamed in
+    afterwards, full-resolution images are loaded on selection.
+    """
     if not paper_id or paper_id == NO_RES_ID:
         desc_text = NO_RES_MSG if paper_id == NO_RES_ID else SEL_PAPER_MSG
-        return desc_text, []
+        yield desc_text, [], None
+        return
 
     paper_info = paper_store.get_paper_details_by_id(paper_id)
     if not paper_info:
         # This case should be rare if UI and store are in sync
-        return f"Error: Could not find data for paper ID '{paper_id}'.", []
+        yield f"Error: Could not find data for paper ID '{paper_id}'.", [], None
+        return
+
+    desc_text = paper_info.get("desc", "No description available.")
+    yield desc_text, [], None
+    yield desc_text, paper_store.get_paper_thumbnails(paper_id), None
+
 
-    return paper_info.get("desc", "No description available."), paper_info.get(
-        "imgs", []
-    )
+def handle_select_paper_image(
+    paper_id: Optional[str], evt: gr.SelectData, paper_store: PaperStore
+):
+    """Loads the full-resolution version of the selected gallery image."""
+    if not paper_id or paper_id == NO_RES_ID:
+        return None
+    return paper_store.get_paper_image(paper_id, evt.index)
 
 
-def handle_model_test(pdf, data):
+def handle_model_test(pdf, data, selected_models=None):
     # clear data
     data.loc[1:, data.columns[1:]] = 0
 
@@ -189,13 +190,13 @@ def handle_model_test(pdf, data):
         """Counts the number of detected classes."""
         class_counts = {}
         for result in results:
-            boxes = result.boxes
-            for box in boxes:
-                class_id = int(box.cls[0])
-                class_name = result.names[class_id]
-                class_counts[class_name] = class_counts.get(class_name, 0) + 1
+            class_ids, _, names = box_arrays(result)
+            ids, counts = np.unique(class_ids, return_counts=True)
+            for class_id, count in zip(ids.tolist(), counts.tolist()):
+                class_name = names[class_id]
+                class_counts[class_name] = class_counts.get(class_name, 0) + count
                 row_index = LABEL_MAP[class_name] + 1
-                data.loc[row_index, model_name] += 1
+                data.loc[row_index, model_name] += count
         return class_counts
 
     def mix_images_grid(images, cols=3):
@@ -224,14 +225,29 @@ def handle_model_test(pdf, data):
         grid_image = np.vstack(row_imgs)
         return grid_image
 
-    images = pdf2image.pdf_to_images(pdf.name)
+    with PDFDocument(pdf.name) as doc:
+        images = list(doc.iter_images(workers=RASTER_WORKERS))
 
     all_image = [[img] for img in images]
 
-    for model_name, model_instance in MODELS_INSTANCES.items():
+    selected_models = set(selected_models or [])
+    for model_name in MODELS_INSTANCES:
+        # 只載入勾選的模型, 其他模型僅在已載入時測試
+        if model_name in selected_models:
+            model_instance = MODELS_INSTANCES[model_name]
+        else:
+            model_instance = MODELS_INSTANCES.peek(model_name)
+        if model_instance is None:
+            data.loc[0, model_name] = "not loaded"
+            continue
+        if not getattr(model_instance, "available", True):
+            data.loc[0, model_name] = "unavailable"
+            continue
         # 計算推論時間
         t1 = time.time()
-        results = model_instance(images)
+        results = [
+            result for _, result in run_detection(model_name, model_instance, images)
+        ]
         t2 = time.time()
         # 產生圖片
         if isinstance(model_instance, APIModel):
@@ -247,13 +263,7 @@ def handle_model_test(pdf, data):
                     (255, 0, 0),
                     2,
                 )
-                for item in result:
-                    box = item["box"]
-                    name = item["name"]
-                    x1 = int(box["x1"])
-                    y1 = int(box["y1"])
-                    x2 = int(box["x2"])
-                    y2 = int(box["y2"])
+                for name, x1, y1, x2, y2 in detections(model_instance, result):
                     cv2.rectangle(img_with_boxes, (x1, y1), (x2, y2), (0, 255, 0), 2)
                     cv2.putText(
                         img_with_boxes,
@@ -264,9 +274,8 @@ def handle_model_test(pdf, data):
                         (255, 0, 0),
                         2,
                     )
-                    row_index = LABEL_MAP[name] + 1
-                    data.loc[row_index, model_name] += 1
                 all_image[i].append(img_with_boxes)
+            count_classes(results, model_name)
         if isinstance(model_instance, YOLO) or isinstance(model_instance, RTDETR):
             for i, item in enumerate(results):
                 img_with_boxes = item.plot()
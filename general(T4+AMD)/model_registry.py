@@ -0,0 +1,102 @@
+import gc
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+
+class ModelRegistry(Mapping):
+    """Read-only mapping of model names to models that are created on first use.
+
+    `factories` build the models that hold weights in memory. At most `max_loaded`
+    of them stay loaded, the least recently used one is unloaded when another model
+    is needed and loaded again on its next use. `instances` are cheap models, such
+    as remote ones, which are always available and do not count towards the limit.
+    """
+
+    def __init__(
+        self,
+        factories: Dict[str, Callable[[], Any]],
+        instances: Optional[Dict[str, Any]] = None,
+        max_loaded: Optional[int] = None,
+    ):
+        self.factories = dict(factories)
+        self.instances = dict(instances or {})
+        self.max_loaded = max_loaded
+        self._loaded = OrderedDict()  # name -> model, least recently used first
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.factories}
+
+    def __getitem__(self, name: str):
+        if name in self.instances:
+            return self.instances[name]
+        if name not in self.factories:
+            raise KeyError(name)
+        with self._lock:
+            model = self._loaded.get(name)
+            if model is not None:
+                self._loaded.move_to_end(name)
+                return model
+        # Load outside of the registry lock so other models stay usable meanwhile
+        with self._load_locks[name]:
+            with self._lock:
+                model = self._loaded.get(name)
+            if model is None:
+                print(f"Loading model {name}")
+                model = self.factories[name]()
+            with self._lock:
+                self._loaded[name] = model
+                self._loaded.move_to_end(name)
+                self._evict()
+        return model
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.factories
+        yield from (name for name in self.instances if name not in self.factories)
+
+    def __len__(self) -> int:
+        return len(self.factories.keys() | self.instances.keys())
+
+    def peek(self, name: str):
+        """Returns the model if it is available without loading it, else None."""
+        if name in self.instances:
+            return self.instances[name]
+        with self._lock:
+            return self._loaded.get(name)
+
+    def resident(self) -> Dict[str, Any]:
+        """Returns the models that are currently available without loading."""
+        with self._lock:
+            return {**self.instances, **self._loaded}
+
+    def _evict(self):
+        if self.max_loaded is None:
+            return
+        evicted = False
+        while len(self._loaded) > self.max_loaded:
+            name, _ = self._loaded.popitem(last=False)
+            print(f"Unloading model {name}")
+            evicted = True
+        if evicted:
+            gc.collect()
+            try:
+                import torch
+
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+
+    def preload(self, names: Iterable[str]) -> threading.Thread:
+        """Loads the given models on a background thread."""
+
+        def load():
+            for name in names:
+                try:
+                    self[name]
+                except Exception as e:
+                    print(f"Failed to preload model {name}: {e}")
+
+        thread = threading.Thread(target=load, name="model-preload", daemon=True)
+        thread.start()
+        return thread
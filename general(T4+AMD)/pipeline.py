@@ -0,0 +1,378 @@
+import asyncio
+import hashlib
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+from paper_store import PaperStore
+from constants import (
+    PROMPT,
+    KEYWORDS_PROMPT,
+    MODELS_INSTANCES,
+    RASTER_WORKERS,
+    PIPELINE_PAPERS_IN_FLIGHT,
+    PIPELINE_OCR_WORKERS,
+    PIPELINE_OCR_PROCESSES,
+    TEXT_LAYER_FIRST,
+    PIPELINE_LLM_CONCURRENCY,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_PAGE_BUFFER,
+)
+from document import PDFDocument
+import detection
+import ocr
+import gemini
+
+# End-of-stream marker passed between stages.
+_STOP = object()
+
+
+@dataclass
+class PaperJob:
+    """A single PDF travelling through the ingestion stages."""
+
+    filename: str
+    path: str
+    content_hash: str
+    replaces: Optional[str] = None
+    doc: Optional[PDFDocument] = None
+    pages: Optional[queue.Queue] = None
+    boxes: List[list] = field(default_factory=list)
+    figures: List[np.ndarray] = field(default_factory=list)
+    titles: List[np.ndarray] = field(default_factory=list)
+    chapters: List[np.ndarray] = field(default_factory=list)
+    title_texts: List[str] = field(default_factory=list)
+    chapter_texts: List[str] = field(default_factory=list)
+    context: str = ""
+    desc: str = ""
+    keywords: List[str] = field(default_factory=list)
+
+
+def file_sha256(path: str) -> str:
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _digest(data: bytes | str | np.ndarray) -> str:
+    """Returns a short hex digest used to key cached results by their input."""
+    digest = hashlib.sha256()
+    if isinstance(data, np.ndarray):
+        digest.update(str(data.shape).encode())
+        data = np.ascontiguousarray(data).tobytes()
+    elif isinstance(data, str):
+        data = data.encode("utf-8")
+    digest.update(data)
+    return digest.hexdigest()[:32]
+
+
+def _iter_queue(q: queue.Queue) -> Iterator[Any]:
+    """Yields items from `q` until the end marker, re-raising forwarded errors."""
+    while (item := q.get()) is not _STOP:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class IngestPipeline:
+    """Runs rasterize -> detect -> OCR -> Gemini over several papers at once.
+
+    Each stage is connected to the next one by a bounded queue, so only a few papers
+    are in flight at any time. Rasterization streams pages into a small per-paper
+    buffer, detection runs on a single thread that owns the accelerator, OCR and
+    text extraction run on a thread pool, with the crops of each paper recognized in
+    batches by a pool of OCR processes, and the Gemini calls share one event loop.
+
+    Each PDF is opened once as a `PDFDocument`, which is shared by rasterization
+    and text extraction and closed once the text is extracted.
+
+    Results of every stage are cached in the paper store by PDF content hash. Stages
+    that depend on the detector are keyed by the model name, the others by a digest
+    of their input, so re-ingesting a paper with another model reuses them.
+
+    With `refresh`, cached results are ignored and every stage runs again, its new
+    results replacing the cached ones.
+
+    With `text_layer`, the text of title and chapter boxes is taken from the text
+    embedded in the PDF, and only boxes without any, e.g. on scanned pages, are OCRed.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        cache: PaperStore,
+        papers_in_flight: int = PIPELINE_PAPERS_IN_FLIGHT,
+        ocr_workers: int = PIPELINE_OCR_WORKERS,
+        ocr_processes: int = PIPELINE_OCR_PROCESSES,
+        text_layer: bool = TEXT_LAYER_FIRST,
+        llm_concurrency: int = PIPELINE_LLM_CONCURRENCY,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        refresh: bool = False,
+    ):
+        self.model = model
+        self.cache = cache
+        self.refresh = refresh
+        self.papers_in_flight = papers_in_flight
+        self.ocr_workers = ocr_workers
+        self.ocr_processes = ocr_processes
+        self.text_layer = text_layer
+        self.llm_concurrency = llm_concurrency
+        self.queue_size = queue_size
+        self._events = queue.Queue()
+
+    def _log(self, job: PaperJob, message: str):
+        self._events.put(("log", job, f"[{job.filename}] {message}"))
+
+    def _get_cached(self, job: PaperJob, model: str, stage: str):
+        """Returns the cached result of a stage, None if missing or refreshing."""
+        if self.refresh:
+            return None
+        return self.cache.get_cached(job.content_hash, model, stage)
+
+    def _cached(self, job: PaperJob, model: str, stage: str, compute: Callable):
+        """Returns the cached result of a stage, computing and storing it on a miss."""
+        value = self._get_cached(job, model, stage)
+        if value is None:
+            value = compute()
+            self.cache.set_cached(job.content_hash, model, stage, value)
+        return value
+
+    async def _cached_async(
+        self, job: PaperJob, model: str, stage: str, compute: Callable
+    ):
+        """Same as `_cached` for a coroutine function `compute`."""
+        value = self._get_cached(job, model, stage)
+        if value is None:
+            value = await compute()
+            self.cache.set_cached(job.content_hash, model, stage, value)
+        return value
+
+    def _start_stage(
+        self,
+        name: str,
+        work: Callable[[PaperJob], None],
+        inbox: queue.Queue,
+        outbox: queue.Queue,
+        workers: int = 1,
+        forward: bool = True,
+    ):
+        """Runs `work` on `workers` threads for every job from `inbox`.
+
+        Finished jobs are forwarded to `outbox` unless `forward` is False, failed ones
+        are reported as errors. The end marker is always forwarded to `outbox` once
+        all workers of the stage have stopped.
+        """
+
+        def loop():
+            while (job := inbox.get()) is not _STOP:
+                try:
+                    work(job)
+                except Exception as e:
+                    self._events.put(("error", job, e))
+                    continue
+                if forward:
+                    outbox.put(job)
+            inbox.put(_STOP)  # let the sibling workers see the end marker too
+
+        threads = [
+            threading.Thread(target=loop, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        def close():
+            for thread in threads:
+                thread.join()
+            outbox.put(_STOP)
+
+        threading.Thread(target=close, name=f"{name}-close", daemon=True).start()
+
+    def _rasterize(self, job: PaperJob, detect_q: queue.Queue):
+        """Hands the job to detection, then streams its pages into the job buffer."""
+        job.pages = queue.Queue(maxsize=PIPELINE_PAGE_BUFFER)
+        detect_q.put(job)
+        try:
+            job.doc = PDFDocument(job.path)
+            for page in job.doc.iter_images(workers=RASTER_WORKERS):
+                job.pages.put(page)
+        except Exception as e:
+            job.pages.put(e)
+        job.pages.put(_STOP)
+
+    def _detect(self, job: PaperJob):
+        drained = False
+
+        def pages():
+            nonlocal drained
+            yield from _iter_queue(job.pages)
+            drained = True
+
+        def record(found):
+            for img, boxes in found:
+                job.boxes.append(boxes)
+                yield img, boxes
+
+        try:
+            # Looking the model up may load or export it, which can fail as well.
+            cached_boxes = self._get_cached(job, self.model, "detections")
+            if cached_boxes is None:
+                model_instance = MODELS_INSTANCES[self.model]
+                found = detection.page_detections(self.model, model_instance, pages())
+            else:
+                found = zip(pages(), cached_boxes)
+            job.figures, job.titles, job.chapters = detection.crop_detections(
+                record(found)
+            )
+        except Exception:
+            # Drain the buffer so that the rasterizer of this job is not left blocked.
+            while not drained and job.pages.get() is not _STOP:
+                pass
+            if job.doc is not None:
+                job.doc.close()
+            raise
+        finally:
+            job.pages = None
+        if cached_boxes is None:
+            self.cache.set_cached(job.content_hash, self.model, "detections", job.boxes)
+        self._log(
+            job,
+            f"Detected {len(job.figures)} figures/tables, {len(job.titles)} titles "
+            f"and {len(job.chapters)} chapters.",
+        )
+
+    def _ocr(self, job: PaperJob, images: List[np.ndarray]) -> List[str]:
+        """OCR of all the crops of a paper at once, reusing the cached texts."""
+        keys = [f"ocr:{_digest(image)}" for image in images]
+        texts = [self._get_cached(job, "", key) for key in keys]
+        missing = [i for i, text in enumerate(texts) if text is None]
+        if missing:
+            found = ocr.ocr_images(
+                [images[i] for i in missing], workers=self.ocr_processes
+            )
+            for i, text in zip(missing, found):
+                texts[i] = text
+                self.cache.set_cached(job.content_hash, "", keys[i], text)
+        return texts
+
+    def _extract_text(self, job: PaperJob):
+        try:
+            crops = job.titles + job.chapters
+            texts = [""] * len(crops)
+            if self.text_layer:
+                titles, chapters = detection.text_boxes(job.boxes)
+                if len(titles) + len(chapters) == len(crops):
+                    texts = job.doc.boxes_text(titles + chapters)
+
+            # Perform OCR on the title and chapter images without embedded text
+            missing = [i for i, text in enumerate(texts) if not text]
+            found = self._ocr(job, [crops[i] for i in missing])
+            for i, text in zip(missing, found):
+                texts[i] = text
+            job.title_texts = texts[: len(job.titles)]
+            job.chapter_texts = texts[len(job.titles) :]
+
+            # Combine all texts for context
+            job.context = self._cached(job, "", "text", job.doc.text)
+        finally:
+            # Later stages only need the extracted text
+            job.doc.close()
+            job.doc = None
+        self._log(
+            job,
+            f"Extracted title, chapter and page text, OCR of {len(missing)} of "
+            f"{len(crops)} boxes.",
+        )
+
+    async def _summarize(self, job: PaperJob):
+        prompt = (
+            PROMPT.replace("{{CONTEXT}}", job.context)
+            .replace("{{TITLE}}", " ".join(job.title_texts))
+            .replace("{{CHAPTERS}}", " ".join(job.chapter_texts))
+        )
+        job.desc = await self._cached_async(
+            job,
+            "",
+            f"summary:{_digest(prompt)}",
+            lambda: gemini.generate_text_async(prompt),
+        )
+
+        # get keywords from the generated text
+        async def extract_keywords():
+            generated_keywords = await gemini.generate_text_async(
+                KEYWORDS_PROMPT.replace("{{TEXT}}", job.desc)
+            )
+            return [kw.strip() for kw in generated_keywords.split(",") if kw.strip()]
+
+        job.keywords = await self._cached_async(
+            job, "", f"keywords:{_digest(job.desc)}", extract_keywords
+        )
+
+    async def _llm_stage(self, inbox: queue.Queue):
+        """Summarizes up to `llm_concurrency` papers concurrently."""
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.llm_concurrency)
+        tasks = set()
+
+        async def run(job: PaperJob):
+            try:
+                await self._summarize(job)
+            except Exception as e:
+                self._events.put(("error", job, e))
+            else:
+                self._events.put(("done", job, None))
+            finally:
+                limit.release()
+
+        try:
+            while True:
+                await limit.acquire()
+                job = await loop.run_in_executor(None, inbox.get)
+                if job is _STOP:
+                    break
+                task = asyncio.create_task(run(job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            self._events.put(("stop", None, None))
+
+    def run(self, jobs: Iterable[PaperJob]) -> Iterator[Tuple[str, PaperJob, Any]]:
+        """Processes the jobs and yields (event, job, payload) as papers progress.
+
+        Events are ``"log"`` with a message, ``"done"`` once a job is fully processed
+        and ``"error"`` with the exception that made a job fail.
+        """
+        raster_q = queue.Queue()
+        detect_q = queue.Queue()
+        ocr_q = queue.Queue(maxsize=self.queue_size)
+        llm_q = queue.Queue(maxsize=self.queue_size)
+        for job in jobs:
+            raster_q.put(job)
+        raster_q.put(_STOP)
+
+        # Rasterizers hand each job to detection before streaming its pages.
+        self._start_stage(
+            "rasterize",
+            lambda job: self._rasterize(job, detect_q),
+            raster_q,
+            detect_q,
+            workers=self.papers_in_flight,
+            forward=False,
+        )
+        self._start_stage("detect", self._detect, detect_q, ocr_q)
+        self._start_stage(
+            "ocr", self._extract_text, ocr_q, llm_q, workers=self.ocr_workers
+        )
+        threading.Thread(
+            target=asyncio.run, args=(self._llm_stage(llm_q),), daemon=True
+        ).start()
+
+        while (event := self._events.get())[0] != "stop":
+            yield event
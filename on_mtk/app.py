@@ -10,9 +10,12 @@ from handlers import (
     handle_load_initial_search_view,
     handle_search_query,
     handle_display_paper_details,
+    handle_select_paper_image,
     handle_model_test
 )
-from constants import MODELS, SEL_PAPER_MSG, CUSTOM_CSS, LABEL_MAP
+from constants import MODELS, SEL_PAPER_MSG, CUSTOM_CSS, LABEL_MAP, MODELS_INSTANCES, PRELOAD_MODELS, PIPELINE_OCR_PROCESSES
+import ocr
+import threading
 
 # Initialize the paper store (a single instance for the app's lifecycle)
 paper_store_instance = PaperStore()
@@ -28,6 +31,9 @@ _handle_search_query = partial(handle_search_query, paper_store=paper_store_inst
 _handle_display_paper_details = partial(
     handle_display_paper_details, paper_store=paper_store_instance
 )
+_handle_select_paper_image = partial(
+    handle_select_paper_image, paper_store=paper_store_instance
+)
 
 
 with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
@@ -45,6 +51,11 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
             label="Upload PDF", file_types=[".pdf"]
         )
 
+        # 未勾選的模型只有在已載入時才會測試
+        test_models = gr.CheckboxGroup(
+            label="Models to load", choices=list(MODELS_INSTANCES.factories), value=PRELOAD_MODELS
+        )
+
         btn = gr.Button("Run Model", variant="primary")
 
         table = gr.DataFrame(pd.DataFrame(data), interactive=False)
@@ -58,7 +69,7 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
         
         btn.click(
             fn=handle_model_test,
-            inputs=[pdf, table],
+            inputs=[pdf, table, test_models],
             outputs=[table, gallary],
         )
        
@@ -67,11 +78,14 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
         pdf_upload = gr.File(
             label="Upload PDF(s)", file_types=[".pdf"], file_count="multiple"
         )
+        reprocess_checkbox = gr.Checkbox(
+            label="Re-process papers that are already stored", value=False
+        )
         run_button = gr.Button("Run Analysis", variant="primary")
         status_log = gr.Textbox(label="Status Log", lines=8, interactive=False)
         run_button.click(
             fn=_handle_pdf_processing,
-            inputs=[model_choice, pdf_upload],
+            inputs=[model_choice, pdf_upload, reprocess_checkbox],
             outputs=[status_log, pdf_upload],
             show_progress="full",
         )
@@ -109,6 +123,10 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
                         height="auto",
                         elem_id="image-gallery-component",
                     )
+                    full_image = gr.Image(
+                        label="Selected image (full resolution)",
+                        interactive=False,
+                    )
 
         search_outputs = [paper_radio, paper_desc, image_gallery]
         search_button.click(
@@ -120,9 +138,14 @@ with gr.Blocks(theme=gr.themes.Default(), css=CUSTOM_CSS) as app:
         paper_radio.change(
             fn=_handle_display_paper_details,
             inputs=[paper_radio],
-            outputs=[paper_desc, image_gallery],
+            outputs=[paper_desc, image_gallery, full_image],
             show_progress="full",
         )
+        image_gallery.select(
+            fn=_handle_select_paper_image,
+            inputs=[paper_radio],
+            outputs=[full_image],
+        )
         search_tab.select(
             fn=_handle_load_initial_search_view,
             inputs=None,
@@ -138,4 +161,13 @@ if __name__ == "__main__":
         os.environ["GOOGLE_API_KEY"] = getpass.getpass(
             "Enter your Gemini API key (will not be stored): "
         )
+    # Models and the OCR readers are loaded lazily, warm them up in the
+    # background so the UI is served right away.
+    MODELS_INSTANCES.preload(PRELOAD_MODELS)
+    threading.Thread(
+        target=ocr.warm_up,
+        args=(PIPELINE_OCR_PROCESSES,),
+        name="ocr-preload",
+        daemon=True,
+    ).start()
     app.launch(debug=True)
@@ -1,18 +1,54 @@
+import os
+from functools import partial
 from ultralytics import YOLO, RTDETR
+from model_registry import ModelRegistry
+from backends import load_model
 
-MODELS = ["YOLO-plain", "YOLO-large_batch", "YOLO-adam_optimizer","tf-plain", "tf-large_batch", "tf-adam_optimizer", "RTDETR"]
+MODELS = ["YOLO-plain", "YOLO-large_batch", "YOLO-adam_optimizer"]
 NO_RES_ID = "NO_RES_ID"
 NO_RES_MSG = "No papers found matching the search query."
 SEL_PAPER_MSG = "Please select a paper to view details."
-MODELS_INSTANCES = {
-    "YOLO-plain": YOLO("models/YOLO-plain.pt"),
-    "YOLO-large_batch": YOLO("models/YOLO-large_batch.pt"),
-    "YOLO-adam_optimizer": YOLO("models/YOLO-adam_optimizer.pt"),
-    # "YOLO-plain_tflite": YOLO("models/best_float32.tflite"),
-    # "YOLO-batch_tflite": YOLO("models/batch_float32.tflite"),
-    # "YOLO-adam_tflite": YOLO("models/adamw_float32.tflite"),
-    # "RTDETR": RTDETR("models/RTDETR.pt"),
+# Models are loaded on first use, at most MAX_LOADED_MODELS stay in memory.
+MAX_LOADED_MODELS = 2
+# Runtime of the models: "auto" uses PyTorch on a GPU and otherwise the first installed
+# of OpenVINO, ONNX Runtime and TFLite, exports are cached next to the .pt files.
+# Set MODEL_BACKEND=tflite to run the TFLite exports on the board.
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "auto")
+# TFLite exports are float16. Set to a dataset YAML of document pages to export int8
+# models calibrated on them instead.
+TFLITE_CALIBRATION_DATA = os.getenv("TFLITE_CALIBRATION_DATA")
+MODELS_INSTANCES = ModelRegistry({
+    "YOLO-plain": partial(load_model, YOLO, "models/YOLO-plain.pt", backend=MODEL_BACKEND, data=TFLITE_CALIBRATION_DATA),
+    "YOLO-large_batch": partial(load_model, YOLO, "models/YOLO-large_batch.pt", backend=MODEL_BACKEND, data=TFLITE_CALIBRATION_DATA),
+    "YOLO-adam_optimizer": partial(load_model, YOLO, "models/YOLO-adam_optimizer.pt", backend=MODEL_BACKEND, data=TFLITE_CALIBRATION_DATA),
+    # Add "RTDETR" to MODELS as well when enabling it.
+    # "RTDETR": partial(load_model, RTDETR, "models/RTDETR.pt", backend=MODEL_BACKEND, data=TFLITE_CALIBRATION_DATA),
+}, max_loaded=MAX_LOADED_MODELS)
+# Models loaded in the background once the UI is up.
+PRELOAD_MODELS = ["YOLO-plain"]
+# Number of pages passed to each model per call when processing PDFs.
+MODELS_BATCH_SIZES = {
+    "YOLO-plain": 4,
+    "YOLO-large_batch": 4,
+    "YOLO-adam_optimizer": 4,
+    "RTDETR": 2,
 }
+DEFAULT_BATCH_SIZE = 4
+# Worker processes used to rasterize PDF pages, 1 renders in-process.
+RASTER_WORKERS = min(4, os.cpu_count() or 1)
+# Ingestion pipeline limits: papers rasterized at once, OCR threads, concurrent
+# Gemini requests, size of the queues between stages and pages buffered per paper.
+PIPELINE_PAPERS_IN_FLIGHT = 2
+PIPELINE_OCR_WORKERS = 2
+PIPELINE_LLM_CONCURRENCY = 4
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_PAGE_BUFFER = 2 * DEFAULT_BATCH_SIZE
+# Processes that run OCR, each with its own EasyOCR reader (several hundred MB),
+# 1 runs in-process.
+PIPELINE_OCR_PROCESSES = min(2, os.cpu_count() or 1)
+# Take the text of title and chapter boxes from the PDF text layer when there is
+# one, and only OCR the boxes without embedded text.
+TEXT_LAYER_FIRST = True
 CUSTOM_CSS = """
 #search-bar-container > .gr-form {
     display: flex;
@@ -75,6 +111,9 @@ Title: {{TITLE}}
 Chapters: {{CHAPTERS}}
 Context of the paper: {{CONTEXT}}
 """
+KEYWORDS_PROMPT = """Extract keywords from the following text in a comma-separated format, please do not include any additional text or formatting:
+
+text: {{TEXT}}"""
 
 LABEL_MAP = {
      "title":0,
@@ -9,3 +9,13 @@ def generate_text(prompt: str, model: str = "gemini-1.5-flash") -> str:
         return response.text.strip()
     except Exception as e:
         raise RuntimeError(f"Error generating text with model '{model}': {str(e)}") from e
+
+
+async def generate_text_async(prompt: str, model: str = "gemini-1.5-flash") -> str:
+    """Generate text using Google Gemini AI without blocking the event loop."""
+    try:
+        client = genai.Client()
+        response = await client.aio.models.generate_content(model=model, contents=prompt)
+        return response.text.strip()
+    except Exception as e:
+        raise RuntimeError(f"Error generating text with model '{model}': {str(e)}") from e
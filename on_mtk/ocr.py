@@ -1,7 +1,33 @@
-import easyocr
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Sequence
 import numpy as np
 
-reader = easyocr.Reader(['en'], gpu=False)
+from process_pool import SharedPool
+
+# Crops are padded to a multiple of this size, so that crops of similar size share
+# a shape and go through the detector and recognizer together.
+SIZE_STEP = 32
+# Number of text lines per recognizer batch.
+OCR_BATCH_SIZE = 16
+
+_reader = None
+_reader_lock = threading.Lock()
+
+def get_reader():
+    """
+    Return the shared EasyOCR reader, creating it on first use.
+
+    Importing easyocr and loading its weights takes several seconds, so it is
+    deferred until the first page is read (or warmed up in the background).
+    """
+    global _reader
+    with _reader_lock:
+        if _reader is None:
+            import easyocr
+            _reader = easyocr.Reader(['en'], gpu=False)
+        return _reader
 
 def ocr_image(image : np.ndarray) -> str:
     """
@@ -11,8 +37,103 @@ def ocr_image(image : np.ndarray) -> str:
     :return: Extracted text from the image.
     """
     try:
-        results = reader.readtext(image, detail=1, paragraph=True)
+        results = get_reader().readtext(image, detail=1, paragraph=True)
         extracted_text = " ".join([result[1] for result in results])
         return extracted_text
     except Exception as e:
-        return f"Error during OCR processing: {str(e)}"
\ No newline at end of file
+        return f"Error during OCR processing: {str(e)}"
+
+def _padded_shape(image: np.ndarray) -> tuple:
+    h, w = image.shape[:2]
+    return (-(-h // SIZE_STEP) * SIZE_STEP, -(-w // SIZE_STEP) * SIZE_STEP)
+
+def _pad(image: np.ndarray, shape: tuple) -> np.ndarray:
+    """Pads the crop with white, the page background, up to `shape`."""
+    h, w = image.shape[:2]
+    if (h, w) == shape:
+        return image
+    canvas = np.full(shape + image.shape[2:], 255, dtype=image.dtype)
+    canvas[:h, :w] = image
+    return canvas
+
+def _ocr_group(images: List[np.ndarray], batch_size: int) -> List[str]:
+    """OCR of crops with the same padded shape, batched through EasyOCR."""
+    shape = _padded_shape(images[0])
+    try:
+        results = get_reader().readtext_batched(
+            [_pad(image, shape) for image in images],
+            batch_size=batch_size, detail=1, paragraph=True,
+        )
+        return [" ".join([result[1] for result in page]) for page in results]
+    except Exception:
+        # Fall back to one crop at a time, which reports errors per crop
+        return [ocr_image(image) for image in images]
+
+def _ocr_chunk(images: List[np.ndarray], batch_size: int = OCR_BATCH_SIZE) -> List[str]:
+    """OCR of the crops in-process, grouped by padded shape, in input order."""
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(_padded_shape(image), []).append(i)
+    texts = [""] * len(images)
+    for indices in groups.values():
+        found = _ocr_group([images[i] for i in indices], batch_size)
+        for i, text in zip(indices, found):
+            texts[i] = text
+    return texts
+
+def _init_worker(workers: int):
+    """Creates the reader once per OCR process."""
+    global _reader
+    try:
+        import torch
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    except ImportError:
+        pass
+    import easyocr
+    _reader = easyocr.Reader(['en'], gpu=False)
+
+# OCR workers, which only import this module and easyocr, each with its own reader.
+_pool = SharedPool(_init_worker)
+
+def warm_up(workers: int = 1):
+    """Loads the reader(s) that `ocr_images` uses with `workers`."""
+    if workers <= 1:
+        get_reader()
+        return
+    pool = _pool.get(workers)
+    try:
+        # A worker is started for each task that finds no idle one
+        for future in [pool.submit(_ocr_chunk, []) for _ in range(workers)]:
+            future.result()
+    except BrokenProcessPool:
+        _pool.reset()
+        raise
+
+def ocr_images(images: Sequence[np.ndarray], workers: int = 1, batch_size: int = OCR_BATCH_SIZE) -> List[str]:
+    """
+    Perform OCR on several images and return their texts in the same order.
+
+    Images of similar size are padded to the same shape and recognized in batches.
+    With ``workers > 1`` they are split over a pool of processes, each of which
+    loads the reader once, and the reader of this process is never loaded.
+    """
+    images = list(images)
+    if workers <= 1:
+        return _ocr_chunk(images, batch_size)
+    if not images:
+        return []
+    # Sort by shape so that each process gets crops it can batch together
+    order = sorted(range(len(images)), key=lambda i: _padded_shape(images[i]))
+    size = -(-len(order) // workers)
+    shards = [order[start:start + size] for start in range(0, len(order), size)]
+    pool = _pool.get(workers)
+    texts = [""] * len(images)
+    try:
+        futures = [pool.submit(_ocr_chunk, [images[i] for i in shard], batch_size) for shard in shards]
+        for shard, future in zip(shards, futures):
+            for i, text in zip(shard, future.result()):
+                texts[i] = text
+    except BrokenProcessPool:
+        _pool.reset()
+        raise
+    return texts
\ No newline at end of file
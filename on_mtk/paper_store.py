@@ -1,16 +1,106 @@
+import re
 import uuid
+import threading
+import weakref
+from contextlib import contextmanager
 from typing import List, Dict, Tuple, Optional, Any
 from constants import NO_RES_ID, NO_RES_MSG
 import numpy as np
 import sqlite3
 import json
+import cv2
+
+# Applied to every connection. WAL lets readers run while a write is in progress.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 30000",
+    "PRAGMA cache_size = -65536",  # 64 MiB
+    "PRAGMA mmap_size = 268435456",  # 256 MiB
+    "PRAGMA temp_store = MEMORY",
+]
+# Longest side of the thumbnails shown in the gallery before a crop is opened.
+THUMB_SIZE = 320
+
+
+def _release_connection(connections: list, lock: threading.Lock, conn):
+    with lock:
+        if conn in connections:
+            connections.remove(conn)
+    conn.close()
+
+
+class _ThreadConnection:
+    """Holds the connection of a thread and closes it once the thread has ended.
+
+    Instances only live in a `threading.local`, which drops them when their thread
+    exits, so short-lived worker threads do not leave connections behind.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, connections: list, lock):
+        self.conn = conn
+        self.depth = 0
+        with lock:
+            connections.append(conn)
+        weakref.finalize(self, _release_connection, connections, lock, conn)
 
 
 class PaperStore:
     def __init__(self, db_path="paper_store.db"):
         self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Serializes writers within the process, SQLite allows only one at a time.
+        self._write_lock = threading.RLock()
         self._initialize_db()
 
+    def _connect(self) -> sqlite3.Connection:
+        """Returns the calling thread's connection, opening it on first use."""
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # Transactions are managed explicitly by `transaction`.
+            conn = sqlite3.connect(
+                self.db_path, isolation_level=None, check_same_thread=False
+            )
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            holder = _ThreadConnection(conn, self._connections, self._connections_lock)
+            self._local.holder = holder
+        return holder.conn
+
+    @contextmanager
+    def transaction(self):
+        """Runs the enclosed writes in a single transaction.
+
+        Writers are serialized, readers on other threads are not blocked. Nested
+        transactions join the outermost one.
+        """
+        conn = self._connect()
+        holder = self._local.holder
+        with self._write_lock:
+            if holder.depth == 0:
+                conn.execute("BEGIN IMMEDIATE")
+            holder.depth += 1
+            try:
+                yield conn
+            except BaseException:
+                holder.depth -= 1
+                if holder.depth == 0:
+                    conn.execute("ROLLBACK")
+                raise
+            holder.depth -= 1
+            if holder.depth == 0:
+                conn.execute("COMMIT")
+
+    def close(self):
+        """Closes the connections of all threads that are still running."""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
     def _execute_query(
         self,
         query: str,
@@ -18,21 +108,35 @@ class PaperStore:
         fetch_one=False,
         fetch_all=False,
         commit=False,
+        many=False,
     ):
-        """Helper function to execute SQLite queries."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        result = None
+        """Helper function to execute SQLite queries.
+
+        Queries run on the calling thread's pooled connection, ``commit=True`` runs the
+        query as a write inside `transaction`. With ``many=True`` the query is run once
+        per parameter tuple in ``params``.
+        """
+        conn = self._connect()
         if commit:
-            conn.commit()
+            with self.transaction():
+                cursor = self._run_query(conn, query, params, many)
+        else:
+            cursor = self._run_query(conn, query, params, many)
+        result = None
         if fetch_one:
             result = cursor.fetchone()
         elif fetch_all:
             result = cursor.fetchall()
-        conn.close()
+        cursor.close()
         return result
 
+    def _run_query(
+        self, conn: sqlite3.Connection, query: str, params, many: bool
+    ) -> sqlite3.Cursor:
+        if many:
+            return conn.executemany(query, params)
+        return conn.execute(query, params)
+
     def _initialize_db(self):
         """Initializes the database and creates the papers table if it doesn't exist."""
         query = """
@@ -41,27 +145,200 @@ class PaperStore:
             title TEXT NOT NULL,
             desc TEXT,
             imgs TEXT,
-            keywords TEXT 
+            keywords TEXT,
+            content_hash TEXT
         );
         """
         self._execute_query(query, commit=True)
+        self._ensure_column("papers", "content_hash", "TEXT")
         index_query_title = "CREATE INDEX IF NOT EXISTS idx_title ON papers (title);"
         self._execute_query(index_query_title, commit=True)
+        index_query_hash = (
+            "CREATE INDEX IF NOT EXISTS idx_content_hash ON papers (content_hash);"
+        )
+        self._execute_query(index_query_hash, commit=True)
+        # Images live in their own table as encoded BLOBs, one row per image.
+        images_query = """
+        CREATE TABLE IF NOT EXISTS paper_images (
+            paper_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            data BLOB NOT NULL,
+            thumb BLOB,
+            PRIMARY KEY (paper_id, idx)
+        );
+        """
+        self._execute_query(images_query, commit=True)
+        self._ensure_column("paper_images", "thumb", "BLOB")
+        # Intermediate ingestion results, keyed by PDF content hash, model and stage.
+        cache_query = """
+        CREATE TABLE IF NOT EXISTS stage_cache (
+            content_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (content_hash, model, stage)
+        );
+        """
+        self._execute_query(cache_query, commit=True)
+        vacuumed = self._migrate_legacy_imgs()
+        self._initialize_fts(rebuild=vacuumed)
+
+    def _initialize_fts(self, rebuild: bool = False):
+        """Creates the FTS5 index over papers and the triggers that keep it in sync.
+
+        The index is backfilled when it is first created, and rebuilt when `rebuild`
+        is set since VACUUM may renumber the rowids it refers to.
+        """
+        exists = self._execute_query(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'papers_fts'",
+            fetch_one=True,
+        )
+        try:
+            query = """
+            CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+                title, "desc", keywords,
+                content='papers', content_rowid='rowid',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+            """
+            self._execute_query(query, commit=True)
+        except sqlite3.OperationalError as e:
+            print(f"FTS5 is unavailable, falling back to LIKE search: {e}")
+            self.fts_enabled = False
+            return
+        self.fts_enabled = True
+        triggers = [
+            """
+            CREATE TRIGGER IF NOT EXISTS papers_fts_insert AFTER INSERT ON papers BEGIN
+                INSERT INTO papers_fts (rowid, title, "desc", keywords)
+                VALUES (new.rowid, new.title, new."desc", new.keywords);
+            END;
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS papers_fts_delete AFTER DELETE ON papers BEGIN
+                INSERT INTO papers_fts (papers_fts, rowid, title, "desc", keywords)
+                VALUES ('delete', old.rowid, old.title, old."desc", old.keywords);
+            END;
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS papers_fts_update
+            AFTER UPDATE OF title, "desc", keywords ON papers BEGIN
+                INSERT INTO papers_fts (papers_fts, rowid, title, "desc", keywords)
+                VALUES ('delete', old.rowid, old.title, old."desc", old.keywords);
+                INSERT INTO papers_fts (rowid, title, "desc", keywords)
+                VALUES (new.rowid, new.title, new."desc", new.keywords);
+            END;
+            """,
+        ]
+        for trigger in triggers:
+            self._execute_query(trigger, commit=True)
+        if not exists or rebuild:
+            self._execute_query(
+                "INSERT INTO papers_fts (papers_fts) VALUES ('rebuild')", commit=True
+            )
+
+    def _ensure_column(self, table: str, column: str, column_type: str):
+        """Adds a column to an existing table created by an older version."""
+        columns = self._execute_query(f"PRAGMA table_info({table})", fetch_all=True)
+        if column not in (row[1] for row in columns):
+            self._execute_query(
+                f"ALTER TABLE {table} ADD COLUMN {column} {column_type}", commit=True
+            )
 
-    def _serialize_imgs(self, imgs: List[Any]) -> str:
-        """Serializes a list of images (URLs or numpy arrays) to a JSON string."""
-        serialized_imgs = []
+    def _migrate_legacy_imgs(self) -> bool:
+        """Moves JSON-encoded images from the legacy `imgs` column into `paper_images`.
+
+        Returns True if anything was migrated and the database was vacuumed.
+        """
+        query = "SELECT id FROM papers WHERE imgs IS NOT NULL AND imgs != ''"
+        rows = self._execute_query(query, fetch_all=True)
+        if not rows:
+            return False
+        for (paper_id,) in rows:
+            # Load one paper at a time, legacy rows can be tens of MB each.
+            result = self._execute_query(
+                "SELECT imgs FROM papers WHERE id = ?", (paper_id,), fetch_one=True
+            )
+            img_rows = self._encode_imgs(
+                paper_id, self._deserialize_legacy_imgs(result[0])
+            )
+            with self.transaction():
+                self._insert_imgs(img_rows)
+                self._execute_query(
+                    "UPDATE papers SET imgs = NULL WHERE id = ?",
+                    (paper_id,),
+                    commit=True,
+                )
+        print(f"Migrated images of {len(rows)} paper(s) to the paper_images table.")
+        # Reclaim the space freed by the JSON payloads.
+        self._execute_query("VACUUM")
+        return True
+
+    def _serialize_img(self, img: Any) -> Tuple[str, bytes]:
+        """Encodes an image (URL or numpy array) to a (kind, bytes) pair."""
+        if isinstance(img, np.ndarray):
+            ok, buf = cv2.imencode(".png", img)
+            if not ok:
+                raise ValueError(f"Failed to encode image of shape {img.shape}")
+            return "png", buf.tobytes()
+        elif isinstance(img, str):
+            return "url", img.encode("utf-8")
+        else:
+            raise ValueError(f"Unsupported image type: {type(img)}")
+
+    def _deserialize_img(self, kind: str, data: bytes) -> Any:
+        """Decodes a (kind, bytes) pair back to an image."""
+        if kind == "png":
+            return cv2.imdecode(
+                np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED
+            )
+        elif kind == "url":
+            return data.decode("utf-8")
+        else:
+            raise ValueError(f"Unsupported image kind in database: {kind}")
+
+    def _make_thumb(self, img: np.ndarray) -> bytes:
+        """Encodes a downscaled JPEG (PNG with alpha) preview of an image."""
+        scale = THUMB_SIZE / max(img.shape[:2])
+        if scale < 1:
+            size = (
+                max(1, round(img.shape[1] * scale)),
+                max(1, round(img.shape[0] * scale)),
+            )
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        ext = ".png" if img.ndim == 3 and img.shape[2] == 4 else ".jpg"
+        ok, buf = cv2.imencode(ext, img)
+        if not ok:
+            raise ValueError(f"Failed to encode thumbnail of shape {img.shape}")
+        return buf.tobytes()
+
+    def _encode_imgs(self, paper_id: str, imgs: List[Any]) -> List[tuple]:
+        """Encodes the images of a paper into `paper_images` rows."""
+        rows = []
         for img in imgs:
-            if isinstance(img, np.ndarray):
-                serialized_imgs.append({"type": "numpy_array", "data": img.tolist()})
-            elif isinstance(img, str):
-                serialized_imgs.append({"type": "url", "data": img})
-            else:
-                raise ValueError(f"Unsupported image type: {type(img)}")
-        return json.dumps(serialized_imgs)
+            if isinstance(img, np.ndarray) and img.size == 0:
+                continue  # Degenerate crop, nothing to show
+            kind, data = self._serialize_img(img)
+            thumb = self._make_thumb(img) if isinstance(img, np.ndarray) else None
+            rows.append(
+                (
+                    paper_id,
+                    len(rows),
+                    kind,
+                    sqlite3.Binary(data),
+                    sqlite3.Binary(thumb) if thumb else None,
+                )
+            )
+        return rows
 
-    def _deserialize_imgs(self, imgs_json_str: Optional[str]) -> List[Any]:
-        """Deserializes a JSON string back to a list of images."""
+    def _insert_imgs(self, rows: List[tuple]):
+        """Stores encoded image rows in the `paper_images` table."""
+        query = "INSERT OR REPLACE INTO paper_images (paper_id, idx, kind, data, thumb) VALUES (?, ?, ?, ?, ?)"
+        self._execute_query(query, rows, commit=True, many=True)
+
+    def _deserialize_legacy_imgs(self, imgs_json_str: Optional[str]) -> List[Any]:
+        """Deserializes a legacy JSON string back to a list of images."""
         if not imgs_json_str:
             return []
         imgs_data = json.loads(imgs_json_str)
@@ -97,26 +374,78 @@ class PaperStore:
         result = self._execute_query(query, (title,), fetch_one=True)
         return result[0] if result else None
 
+    def find_paper_id_by_hash(self, content_hash: str) -> Optional[str]:
+        """Finds a paper ID by the SHA-256 hash of its PDF content."""
+        query = "SELECT id FROM papers WHERE content_hash = ?"
+        result = self._execute_query(query, (content_hash,), fetch_one=True)
+        return result[0] if result else None
+
+    def find_legacy_paper_id(self, title: str) -> Optional[str]:
+        """Finds a paper with the given title that was stored without a content hash.
+
+        Such papers can only be matched by title, which does not tell whether the PDF
+        is the same, and their source PDF is not kept to verify it.
+        """
+        query = "SELECT id FROM papers WHERE title = ? AND content_hash IS NULL"
+        result = self._execute_query(query, (title,), fetch_one=True)
+        return result[0] if result else None
+
+    def get_cached(self, content_hash: str, model: str, stage: str) -> Optional[Any]:
+        """Returns a cached ingestion result, or None if the stage has not run yet."""
+        query = "SELECT value FROM stage_cache WHERE content_hash = ? AND model = ? AND stage = ?"
+        result = self._execute_query(
+            query, (content_hash, model, stage), fetch_one=True
+        )
+        return json.loads(result[0]) if result else None
+
+    def set_cached(self, content_hash: str, model: str, stage: str, value: Any):
+        """Caches a JSON-serializable ingestion result."""
+        query = "INSERT OR REPLACE INTO stage_cache (content_hash, model, stage, value) VALUES (?, ?, ?, ?)"
+        params = (content_hash, model, stage, json.dumps(value))
+        self._execute_query(query, params, commit=True)
+
     def add_paper(
         self,
         title: str,
         desc: str,
         imgs: List[Any],
         keywords: List[str],
+        content_hash: Optional[str] = None,
+        replaces: Optional[str] = None,
     ) -> str:
-        """Adds a new paper to the database with keywords."""
+        """Adds a new paper to the database with keywords.
+
+        The paper with id `replaces`, if given, is deleted in the same transaction,
+        so it is kept if the insert fails.
+        """
         paper_id = str(uuid.uuid4())
-        query = "INSERT INTO papers (id, title, desc, imgs, keywords) VALUES (?, ?, ?, ?, ?)"
+        query = "INSERT INTO papers (id, title, desc, keywords, content_hash) VALUES (?, ?, ?, ?, ?)"
         params = (
             paper_id,
             title,
             desc,
-            self._serialize_imgs(imgs),
             self._serialize_keywords(keywords),
+            content_hash,
         )
-        self._execute_query(query, params, commit=True)
+        # Encode before taking the write lock, it is the slow part.
+        img_rows = self._encode_imgs(paper_id, imgs)
+        with self.transaction():
+            if replaces:
+                self.delete_paper(replaces)
+            self._execute_query(query, params, commit=True)
+            self._insert_imgs(img_rows)
         return paper_id
 
+    def delete_paper(self, paper_id: str):
+        """Removes a paper and its images from the database."""
+        with self.transaction():
+            self._execute_query(
+                "DELETE FROM paper_images WHERE paper_id = ?", (paper_id,), commit=True
+            )
+            self._execute_query(
+                "DELETE FROM papers WHERE id = ?", (paper_id,), commit=True
+            )
+
     def get_paper_choices(self, ignore_no_res: bool = False) -> List[Tuple[str, str]]:
         """Returns a list of (title, id) tuples for paper selection, sorted by title."""
         query = "SELECT title, id FROM papers ORDER BY title ASC"
@@ -125,12 +454,47 @@ class PaperStore:
             return [] if ignore_no_res else [(NO_RES_MSG, NO_RES_ID)]
         return [(row[0], row[1]) for row in results]
 
+    def _fts_query(self, keyword: str) -> str:
+        """Turns a search string into an FTS5 query.
+
+        Text in double quotes is matched as an exact phrase, every other word matches
+        as a prefix. All parts must match.
+        """
+        parts = []
+        for phrase, word in re.findall(r'"([^"]*)"|(\S+)', keyword):
+            tokens = re.findall(r"\w+", phrase or word)
+            if tokens:
+                parts.append('"' + " ".join(tokens) + '"' + ("" if phrase else "*"))
+        return " AND ".join(parts)
+
     def search_papers(self, keyword: str) -> List[Tuple[str, str]]:
-        """Searches papers by keyword in title, description, or as an exact match in the keywords list."""
-        keyword_lc = keyword.lower().strip()
-        if not keyword_lc:
+        """Searches papers by keyword in title, description and keywords.
+
+        Results are ranked by BM25 with title matches weighted highest. FTS5 only
+        matches words by their start, so when it finds nothing, or without FTS5
+        support, this falls back to substring matching, e.g. "net" finds "ResNet".
+        """
+        if not keyword.strip():
             return self.get_paper_choices()
+        match_query = self._fts_query(keyword) if self.fts_enabled else ""
+        if not match_query:
+            return self._search_papers_like(keyword)
+
+        query = """
+        SELECT papers.title, papers.id FROM papers_fts
+        JOIN papers ON papers.rowid = papers_fts.rowid
+        WHERE papers_fts MATCH ?
+        ORDER BY bm25(papers_fts, 10.0, 1.0, 5.0)
+        """
+        results = self._execute_query(query, (match_query,), fetch_all=True)
 
+        if not results:
+            return self._search_papers_like(keyword)
+        return [(row[0], row[1]) for row in results]
+
+    def _search_papers_like(self, keyword: str) -> List[Tuple[str, str]]:
+        """Searches papers by keyword in title, description, or as an exact match in the keywords list."""
+        keyword_lc = keyword.lower().strip()
         like_pattern_substring = f"%{keyword_lc}%"
         like_pattern_exact_keyword = f'%"{keyword_lc}"%'
 
@@ -152,19 +516,66 @@ class PaperStore:
             return [(NO_RES_MSG, NO_RES_ID)]
         return [(row[0], row[1]) for row in results]
 
-    def get_paper_details_by_id(self, paper_id: str) -> Optional[Dict[str, Any]]:
-        """Retrieves full details for a given paper ID, including keywords."""
-        query = "SELECT id, title, desc, imgs, keywords FROM papers WHERE id = ?"
+    def get_paper_details_by_id(
+        self, paper_id: str, include_imgs: bool = False
+    ) -> Optional[Dict[str, Any]]:
+        """Retrieves details for a given paper ID, including keywords.
+
+        Images are only loaded with `include_imgs`, otherwise use
+        `get_paper_thumbnails` and `get_paper_image` to load them lazily.
+        """
+        query = "SELECT id, title, desc, keywords FROM papers WHERE id = ?"
         result = self._execute_query(query, (paper_id,), fetch_one=True)
         if result:
-            return {
+            details = {
                 "id": result[0],
                 "title": result[1],
                 "desc": result[2],
-                "imgs": self._deserialize_imgs(result[3]),
-                "keywords": self._deserialize_keywords(result[4]),
+                "keywords": self._deserialize_keywords(result[3]),
             }
+            if include_imgs:
+                details["imgs"] = self.get_paper_images(paper_id)
+            return details
         return None
 
+    def get_paper_images(self, paper_id: str) -> List[Any]:
+        """Loads the full-resolution images of a paper in insertion order."""
+        query = "SELECT kind, data FROM paper_images WHERE paper_id = ? ORDER BY idx"
+        results = self._execute_query(query, (paper_id,), fetch_all=True)
+        return [self._deserialize_img(kind, data) for kind, data in results]
+
+    def get_paper_image(self, paper_id: str, idx: int) -> Optional[Any]:
+        """Loads a single full-resolution image of a paper by its position."""
+        query = "SELECT kind, data FROM paper_images WHERE paper_id = ? AND idx = ?"
+        result = self._execute_query(query, (paper_id, idx), fetch_one=True)
+        return self._deserialize_img(*result) if result else None
+
+    def get_paper_thumbnails(self, paper_id: str) -> List[Any]:
+        """Loads the thumbnails of a paper's images in insertion order.
+
+        Thumbnails missing from rows stored by an older version are generated from
+        the full image and saved.
+        """
+        query = (
+            "SELECT idx, kind, thumb FROM paper_images WHERE paper_id = ? ORDER BY idx"
+        )
+        results = self._execute_query(query, (paper_id,), fetch_all=True)
+        thumbs = []
+        for idx, kind, thumb in results:
+            if kind == "url":
+                thumbs.append(self.get_paper_image(paper_id, idx))
+                continue
+            if thumb is None:
+                thumb = self._make_thumb(self.get_paper_image(paper_id, idx))
+                self._execute_query(
+                    "UPDATE paper_images SET thumb = ? WHERE paper_id = ? AND idx = ?",
+                    (sqlite3.Binary(thumb), paper_id, idx),
+                    commit=True,
+                )
+            thumbs.append(
+                cv2.imdecode(np.frombuffer(thumb, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            )
+        return thumbs
+
     def __del__(self):
-        pass
+        self.close()
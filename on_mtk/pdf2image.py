@@ -1,21 +1,151 @@
 import fitz
-from PIL import Image
 import numpy as np
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+from typing import Iterator, Optional
 
+from process_pool import SharedPool
 
-def pdf_to_images(pdf_path: str, zoom_x=2.0, zoom_y=2.0) -> list[np.ndarray]:
+# Pages rendered per task when rasterizing with several processes.
+SHARD_PAGES = 4
+
+# Rasterization workers, which only import this module, PyMuPDF and numpy.
+_pool = SharedPool()
+
+
+def _render_shard(
+    pdf_path: str, zoom_x, zoom_y, start: int, stop: int
+) -> list[tuple[str, tuple]]:
+    """Renders a page range into shared memory blocks, returns their (name, shape)."""
+    pages = []
+    for img in iter_pdf_pages(pdf_path, zoom_x, zoom_y, start, stop):
+        shm = shared_memory.SharedMemory(create=True, size=img.nbytes)
+        np.ndarray(img.shape, dtype=np.uint8, buffer=shm.buf)[:] = img
+        # The parent process owns the block from here on and unlinks it.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        shm.close()
+        pages.append((shm.name, img.shape))
+    return pages
+
+
+def _take_shared_page(name: str, shape: tuple) -> np.ndarray:
+    """Copies a page out of its shared memory block and frees the block."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _iter_pdf_pages_parallel(
+    pdf_path: str,
+    zoom_x,
+    zoom_y,
+    start: int,
+    stop: Optional[int],
+    workers: int,
+    page_count: Optional[int] = None,
+) -> Iterator[np.ndarray]:
+    """Renders page shards in worker processes and yields the pages in order."""
+    if page_count is None:
+        with fitz.open(pdf_path) as doc:
+            page_count = len(doc)
+    stop = page_count if stop is None else min(stop, page_count)
+    shards = deque(
+        (shard_start, min(shard_start + SHARD_PAGES, stop))
+        for shard_start in range(start, stop, SHARD_PAGES)
+    )
+    if len(shards) <= 1:
+        yield from iter_pdf_pages(pdf_path, zoom_x, zoom_y, start, stop)
+        return
+
+    pool = _pool.get(workers)
+    in_flight = deque()
+    ready = deque()
+
+    def submit_next():
+        shard_start, shard_stop = shards.popleft()
+        in_flight.append(
+            pool.submit(
+                _render_shard, pdf_path, zoom_x, zoom_y, shard_start, shard_stop
+            )
+        )
+
+    try:
+        # Keep a bounded number of shards ahead of the consumer to cap memory use.
+        while shards and len(in_flight) < 2 * workers:
+            submit_next()
+        while in_flight or ready:
+            if not ready:
+                ready.extend(in_flight.popleft().result())
+                if shards:
+                    submit_next()
+                continue
+            yield _take_shared_page(*ready.popleft())
+    except BrokenProcessPool:
+        _pool.reset()
+        raise
+    finally:
+        # Free the blocks of pages that were rendered but never consumed.
+        for future in in_flight:
+            if not future.cancel():
+                try:
+                    ready.extend(future.result())
+                except Exception:
+                    pass
+        for name, shape in ready:
+            _take_shared_page(name, shape)
+
+
+def render_page(page, matrix) -> np.ndarray:
+    """Renders a PyMuPDF page to an RGB image.
+
+    The samples are copied once, straight out of the pixmap buffer, so the image owns
+    its memory and stays valid after the pixmap is freed.
+    """
+    pix = page.get_pixmap(matrix=matrix, alpha=False)
+    image = np.empty((pix.height, pix.width, pix.n), dtype=np.uint8)
+    image.reshape(-1)[:] = np.frombuffer(pix.samples_mv, dtype=np.uint8)[: image.size]
+    return image
+
+
+def iter_pdf_pages(
+    pdf_path: str,
+    zoom_x=2.0,
+    zoom_y=2.0,
+    start: int = 0,
+    stop: Optional[int] = None,
+    workers: int = 1,
+    page_count: Optional[int] = None,
+) -> Iterator[np.ndarray]:
+    """Lazily render PDF pages to RGB images, one page at a time.
+
+    Only pages in ``range(start, stop)`` are rendered, ``stop=None`` means the last page.
+    With ``workers > 1`` page ranges are rendered in a process pool and handed back
+    through shared memory, still in page order. Callers that have the file open pass
+    its `page_count`, so that it is not opened again just to count the pages.
+    """
+    if workers > 1:
+        yield from _iter_pdf_pages_parallel(
+            pdf_path, zoom_x, zoom_y, start, stop, workers, page_count
+        )
+        return
+    with fitz.open(pdf_path) as doc:
+        mat = fitz.Matrix(zoom_x, zoom_y)
+        stop = len(doc) if stop is None else min(stop, len(doc))
+        for page_num in range(start, stop):
+            yield render_page(doc.load_page(page_num), mat)
+
+
+def pdf_to_images(
+    pdf_path: str, zoom_x=2.0, zoom_y=2.0, workers: int = 1
+) -> list[np.ndarray]:
     """Convert PDF pages to images with increased resolution."""
     images = []
     try:
-        doc = fitz.open(pdf_path)
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            mat = fitz.Matrix(zoom_x, zoom_y)
-            pix = page.get_pixmap(matrix=mat)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            img_array = np.array(img)
-            images.append(img_array)
-        doc.close()
+        images.extend(iter_pdf_pages(pdf_path, zoom_x, zoom_y, workers=workers))
     except Exception as e:
         print(f"Error converting PDF to images: {e}")
     return images
@@ -0,0 +1,80 @@
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.context import SpawnContext, SpawnProcess
+from typing import Callable, Optional
+
+_start_lock = threading.Lock()
+
+
+class _WorkerProcess(SpawnProcess):
+    """Spawned process that does not re-run the main script of the app.
+
+    Spawned processes normally import the main script again, which here would
+    import torch and gradio and build the whole UI in every worker. Workers only
+    need the module of their task, so the main script is hidden from
+    multiprocessing while the process is started.
+    """
+
+    def start(self):
+        main = sys.modules["__main__"]
+        with _start_lock:
+            saved = main.__dict__.copy()
+            main.__dict__.pop("__file__", None)
+            main.__spec__ = None
+            try:
+                super().start()
+            finally:
+                main.__dict__.update(saved)
+
+
+class _WorkerContext(SpawnContext):
+    Process = _WorkerProcess
+
+
+def spawn_pool(
+    workers: int, initializer: Optional[Callable] = None, initargs: tuple = ()
+) -> ProcessPoolExecutor:
+    """Returns a process pool whose workers start from a fresh interpreter.
+
+    Unlike forking, spawning is safe from a process that already runs threads, as
+    no lock held by another thread is copied into the workers. Tasks and the
+    initializer must be defined in modules that are cheap to import.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=_WorkerContext(),
+        initializer=initializer,
+        initargs=initargs,
+    )
+
+
+class SharedPool:
+    """A spawned process pool shared by all callers and created on first use.
+
+    A new pool is started when another number of workers is asked for, or after
+    `reset`, e.g. once a worker died and broke the pool. The `initializer` is
+    called in every worker with the number of workers of the pool.
+    """
+
+    def __init__(self, initializer: Optional[Callable[[int], None]] = None):
+        self.initializer = initializer
+        self._pool = None
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    def get(self, workers: int) -> ProcessPoolExecutor:
+        """Returns the pool with `workers` processes."""
+        with self._lock:
+            if self._pool is None or self._workers != workers:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                initargs = (workers,) if self.initializer else ()
+                self._pool = spawn_pool(workers, self.initializer, initargs)
+                self._workers = workers
+            return self._pool
+
+    def reset(self):
+        """Drops the pool so that the next call starts a fresh one."""
+        with self._lock:
+            self._pool = None
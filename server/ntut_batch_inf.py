@@ -0,0 +1,264 @@
+# -*- coding=utf-8 -*-
+# NTUT_2025 CV
+# 批次推論: 一次請求處理多張圖片, 結果直接以 JSON 回傳, 不經過磁碟
+# 並將多個用戶端同時送來的請求合併成一次模型呼叫 (dynamic micro-batching)
+import json
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List, NamedTuple
+import cv2
+import numpy as np
+from ntut_metrics import Histogram
+
+# 二進位回應格式 (little endian):
+#   b"NTDT" | uint32 header 長度 | JSON header {"names": {id: name}, "counts": [每張圖的框數]}
+#   | float32 boxes (N, 4) xyxy | float32 scores (N,) | int32 class ids (N,)
+# N 為所有圖片的框數總和, header 以空白補齊到 4 bytes 的倍數
+WIRE_MAGIC = b"NTDT"
+WIRE_CONTENT_TYPE = "application/x-ntut-detections"
+
+
+class Detections(NamedTuple):
+    """Boxes of a single image as arrays."""
+
+    xyxy: np.ndarray  # (n, 4) float32
+    conf: np.ndarray  # (n,) float32
+    cls: np.ndarray  # (n,) int32
+
+
+def to_detections(result) -> Detections:
+    boxes = result.boxes
+    return Detections(
+        boxes.xyxy.cpu().numpy().astype(np.float32).reshape(-1, 4),
+        boxes.conf.cpu().numpy().astype(np.float32).reshape(-1),
+        boxes.cls.cpu().numpy().astype(np.int32).reshape(-1),
+    )
+
+
+def pack_detections(names: Dict[int, str], detections: List[Detections]) -> bytes:
+    """Packs the detections of several images into the binary wire format."""
+    header = json.dumps(
+        {"names": {str(k): v for k, v in names.items()}, "counts": [len(d.cls) for d in detections]}
+    ).encode("utf-8")
+    header += b" " * (-len(header) % 4)
+    parts = [WIRE_MAGIC, struct.pack("<I", len(header)), header]
+    for field in ("xyxy", "conf", "cls"):
+        dtype = "<i4" if field == "cls" else "<f4"
+        arrays = [getattr(d, field) for d in detections]
+        parts.append(np.concatenate(arrays).astype(dtype).tobytes() if arrays else b"")
+    return b"".join(parts)
+
+
+def to_summaries(names: Dict[int, str], detections: List[Detections]) -> List[List[dict]]:
+    """Converts the detections to the JSON layout of ultralytics' `Results.summary()`."""
+    summaries = []
+    for d in detections:
+        summaries.append([
+            {
+                "name": names[int(c)],
+                "class": int(c),
+                "confidence": round(float(p), 5),
+                "box": dict(zip(("x1", "y1", "x2", "y2"), (round(float(v), 5) for v in box))),
+            }
+            for box, p, c in zip(d.xyxy, d.conf, d.cls)
+        ])
+    return summaries
+
+
+def decode_images(blobs: List[bytes]) -> List[np.ndarray]:
+    """Decodes the uploaded image files into BGR arrays."""
+    images = []
+    for i, blob in enumerate(blobs):
+        img = cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Image {i} could not be decoded")
+        images.append(img)
+    return images
+
+
+class _Request:
+    def __init__(self, model_id: str, model, images: List[np.ndarray]):
+        self.model_id = model_id
+        self.model = model
+        self.images = images
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+def _throughput(done) -> float:
+    """Images per second over the (finish time, images, latency) records."""
+    if not done:
+        return 0.0
+    first_submitted = done[0][0] - done[0][2]
+    span = max(done[-1][0] - first_submitted, 1e-3)
+    return sum(n for _, n, _ in done) / span
+
+
+class Overloaded(Exception):
+    """Raised when the inference queue is full."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class MicroBatcher:
+    """Coalesces concurrent inference requests into batched model calls.
+
+    Requests are queued and a single worker thread groups the ones for the same
+    model until `max_batch` images are collected or `max_wait` seconds have passed
+    since the first one. Callers pass the already loaded model, so loading a model
+    never stalls the queue of the others. Each request gets a future resolving to
+    the model's class names and one `Detections` per image.
+
+    At most `max_queue` images wait at a time, further requests are rejected with
+    `Overloaded` so clients back off instead of piling up behind slow inferences.
+    """
+
+    def __init__(self, max_batch: int = 16, max_wait: float = 0.01, max_queue: int = None, window: int = 1024):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._queued_images = 0
+        self._queue = queue.Queue()
+        self._pending = deque()  # requests set aside for a later batch
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._requests = 0
+        self._images = 0
+        self._batches = 0
+        self._errors = 0
+        self._done = deque(maxlen=window)  # (finish time, images, latency)
+        self.batch_images = Histogram(
+            "ntut_batch_images", "Images per model call", (1, 2, 4, 8, 16, 32, 64)
+        )
+        self.inference_seconds = Histogram(
+            "ntut_inference_seconds",
+            "Duration of a batched model call",
+            (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+        )
+        self.request_seconds = Histogram(
+            "ntut_request_seconds",
+            "Time from queueing a request to its result",
+            (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+        )
+        self._thread = threading.Thread(target=self._worker, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def submit(self, model_id: str, model, images: List[np.ndarray]) -> Future:
+        with self._lock:
+            queued = self._queued_images
+            if self.max_queue is not None and queued and queued + len(images) > self.max_queue:
+                raise Overloaded(self._retry_after(queued))
+            self._queued_images += len(images)
+        request = _Request(model_id, model, images)
+        self._queue.put(request)
+        return request.future
+
+    def _retry_after(self, queued: int) -> int:
+        """Estimates in seconds how long the queued images take to drain."""
+        throughput = _throughput(self._done)
+        if not throughput:
+            return 1
+        return int(min(max(np.ceil(queued / throughput), 1), 30))
+
+    def _next(self) -> _Request:
+        if self._pending:
+            return self._pending.popleft()
+        return self._queue.get()
+
+    def _collect(self) -> List[_Request]:
+        first = self._next()
+        batch = [first]
+        size = len(first.images)
+        # requests set aside earlier for the same model go first
+        for request in list(self._pending):
+            if request.model_id == first.model_id:
+                if size + len(request.images) > self.max_batch:
+                    break
+                self._pending.remove(request)
+                batch.append(request)
+                size += len(request.images)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request.model_id != first.model_id:
+                self._pending.append(request)
+            elif size + len(request.images) > self.max_batch:
+                self._pending.append(request)
+                break
+            else:
+                batch.append(request)
+                size += len(request.images)
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            images = [img for request in batch for img in request.images]
+            with self._lock:
+                self._queued_images -= len(images)
+            try:
+                model = batch[0].model
+                started = time.monotonic()
+                results = [to_detections(r) for r in model(images, verbose=False)]
+                names = dict(model.names)
+                self.inference_seconds.observe(time.monotonic() - started)
+                self.batch_images.observe(len(images))
+            except Exception as e:
+                with self._lock:
+                    self._errors += len(batch)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            now = time.monotonic()
+            with self._lock:
+                self._batches += 1
+                for request in batch:
+                    self._requests += 1
+                    self._images += len(request.images)
+                    self._done.append((now, len(request.images), now - request.submitted))
+                    self.request_seconds.observe(now - request.submitted)
+            start = 0
+            for request in batch:
+                end = start + len(request.images)
+                request.future.set_result((names, results[start:end]))
+                start = end
+
+    def stats(self) -> dict:
+        """Returns counters plus throughput and latency over the recent requests."""
+        with self._lock:
+            done = list(self._done)
+            stats = {
+                "requests": self._requests,
+                "images": self._images,
+                "batches": self._batches,
+                "errors": self._errors,
+                "queued": self._queue.qsize() + len(self._pending),
+                "queued_images": self._queued_images,
+                "uptime_s": round(time.monotonic() - self._started, 1),
+                "avg_batch_images": round(self._images / self._batches, 2) if self._batches else 0.0,
+            }
+        if done:
+            latencies = np.array([latency for _, _, latency in done]) * 1000
+            stats["throughput_img_s"] = round(_throughput(done), 2)
+            stats["latency_ms"] = {
+                "p50": round(float(np.percentile(latencies, 50)), 2),
+                "p99": round(float(np.percentile(latencies, 99)), 2),
+                "max": round(float(latencies.max()), 2),
+            }
+        return stats
@@ -0,0 +1,64 @@
+# -*- coding=utf-8 -*-
+# NTUT_2025 CV
+# Prometheus 文字格式的監控指標 (不依賴 prometheus_client)
+import os
+import threading
+from typing import List, Sequence, Tuple
+
+
+class Histogram:
+    """Cumulative histogram rendered in the Prometheus text exposition format."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+            self._sum += value
+            self._count += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+            for bound, count in zip(self.buckets, self._counts):
+                lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {count}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self._count}')
+            lines.append(f"{self.name}_sum {self._sum:.6f}")
+            lines.append(f"{self.name}_count {self._count}")
+        return lines
+
+
+def render_values(kind: str, name: str, help: str, samples: List[Tuple[str, float]]) -> List[str]:
+    """Renders a gauge or counter with (labels, value) samples, labels like 'a="b"'."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+
+def memory_samples() -> List[Tuple[str, float]]:
+    """Resident memory of the process and allocated GPU memory, in bytes."""
+    samples = []
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        samples.append(('device="cpu"', rss_pages * os.sysconf("SC_PAGE_SIZE")))
+    except (OSError, ValueError):
+        pass
+    try:
+        import torch
+
+        for i in range(torch.cuda.device_count()):
+            samples.append((f'device="cuda:{i}"', torch.cuda.memory_allocated(i)))
+    except ImportError:
+        pass
+    return samples
@@ -0,0 +1,276 @@
+# -*- coding=utf-8 -*-
+# NTUT_2025 CV
+# 常駐模型: 以檔案內容的 SHA-256 (或設定檔中的名稱) 作為模型 id, 載入一次後保留在記憶體中
+# 超過記憶體預算時, 最久未使用的模型會被卸載
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+from ultralytics import YOLO, RTDETR
+
+MODEL_CLASSES = {"YOLO": YOLO, "RTDETR": RTDETR}
+MODEL_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def guess_model_type(filename: str) -> str:
+    """Guesses the ultralytics model class from the uploaded file name."""
+    return "RTDETR" if "rtdetr" in filename.lower() else "YOLO"
+
+
+def _model_bytes(model) -> int:
+    """Estimates the memory held by a model from the size of its parameters."""
+    try:
+        return sum(p.numel() * p.element_size() for p in model.model.parameters())
+    except Exception:
+        return 0
+
+
+def _free_memory():
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class ModelRegistry:
+    """Keeps YOLO and RT-DETR models loaded and warmed up, keyed by model id.
+
+    Uploaded models are stored as `<model_dir>/<sha256>.<type>.pt` and their id is
+    the content hash, so clients can check whether a model is already present
+    before uploading it, and large checkpoints can be sent in resumable chunks.
+    Models listed in the JSON config file are available under their configured
+    name, e.g.
+
+        {"models": [{"name": "YOLO-plain", "path": "models/YOLO-plain.pt",
+                     "type": "YOLO", "preload": true}]}
+
+    with paths relative to the config file. Models are loaded on first use, and
+    once the resident ones exceed `memory_budget_mb` the least recently used are
+    unloaded. They are loaded again from disk when requested.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        config_path: str = None,
+        memory_budget_mb: float = None,
+        warmup_size: int = 640,
+    ):
+        self.model_dir = model_dir
+        self.memory_budget = memory_budget_mb * 2**20 if memory_budget_mb else None
+        self.warmup_size = warmup_size
+        self._configured = {}  # name -> (path, type)
+        self._models = OrderedDict()  # model id -> (model, bytes), in LRU order
+        self._loading = {}  # model id -> Future of the load in progress
+        # 只保護 _models 與 _loading; 載入與預熱在鎖外進行, 不阻塞其他模型
+        self._lock = threading.RLock()
+        self._upload_lock = threading.Lock()
+        os.makedirs(model_dir, exist_ok=True)
+        self._preload = []
+        if config_path and os.path.exists(config_path):
+            self._read_config(config_path)
+
+    def _read_config(self, config_path: str):
+        base_dir = os.path.dirname(os.path.abspath(config_path))
+        with open(config_path, encoding="utf-8") as f:
+            config = json.load(f)
+        for entry in config.get("models", []):
+            path = os.path.join(base_dir, entry["path"])
+            model_type = entry.get("type") or guess_model_type(path)
+            if model_type not in MODEL_CLASSES:
+                raise ValueError(f"Unknown model type for {entry['name']}: {model_type}")
+            self._configured[entry["name"]] = (path, model_type)
+            if entry.get("preload"):
+                self._preload.append(entry["name"])
+
+    def preload(self):
+        """Loads the models marked with "preload" in the config file."""
+        for name in self._preload:
+            self.get(name)
+
+    def _locate(self, model_id: str):
+        """Returns the (path, type) of a model id, raising KeyError if unknown."""
+        if model_id in self._configured:
+            return self._configured[model_id]
+        if not MODEL_ID_RE.match(model_id):
+            raise KeyError(f"Invalid model id: {model_id}")
+        for path in glob.glob(os.path.join(self.model_dir, f"{model_id}.*.pt")):
+            model_type = os.path.basename(path).split(".")[1]
+            if model_type in MODEL_CLASSES:
+                return path, model_type
+        raise KeyError(f"Unknown model: {model_id}")
+
+    def add(self, fileobj, model_type: str = "YOLO") -> str:
+        """Stores the uploaded model file, loads it and returns its model id."""
+        if model_type not in MODEL_CLASSES:
+            raise ValueError(f"Unknown model type: {model_type}")
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.model_dir, f".{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, "wb") as buffer:
+                while chunk := fileobj.read(1 << 20):
+                    digest.update(chunk)
+                    buffer.write(chunk)
+            model_id = digest.hexdigest()
+            os.replace(tmp_path, os.path.join(self.model_dir, f"{model_id}.{model_type}.pt"))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.get(model_id)
+        return model_id
+
+    def has(self, model_id: str) -> bool:
+        """Whether the model is known, so clients can skip uploading it."""
+        try:
+            self._locate(model_id)
+        except KeyError:
+            return False
+        return True
+
+    def _part_path(self, model_id: str) -> str:
+        if not MODEL_ID_RE.match(model_id):
+            raise KeyError(f"Invalid model id: {model_id}")
+        return os.path.join(self.model_dir, f".{model_id}.part")
+
+    def received_bytes(self, model_id: str) -> int:
+        """Size of the partial upload of a model, where a resumed upload continues."""
+        part_path = self._part_path(model_id)
+        return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    def append_chunk(self, model_id: str, offset: int, data: bytes) -> int:
+        """Appends a chunk of a resumable upload and returns the bytes received.
+
+        Raises ValueError if `offset` does not match the bytes received so far.
+        """
+        with self._upload_lock:
+            received = self.received_bytes(model_id)
+            if offset != received:
+                raise ValueError(f"Expected offset {received}, got {offset}")
+            with open(self._part_path(model_id), "ab") as f:
+                f.write(data)
+            return received + len(data)
+
+    def finish_upload(self, model_id: str, model_type: str = "YOLO") -> str:
+        """Verifies a chunked upload against its hash, then stores and loads it."""
+        if model_type not in MODEL_CLASSES:
+            raise ValueError(f"Unknown model type: {model_type}")
+        with self._upload_lock:
+            part_path = self._part_path(model_id)
+            if not os.path.exists(part_path):
+                if self.has(model_id):
+                    return model_id
+                raise KeyError(f"No upload in progress for {model_id}")
+            digest = hashlib.sha256()
+            with open(part_path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+            if digest.hexdigest() != model_id:
+                os.remove(part_path)
+                raise ValueError(f"Uploaded data does not match hash {model_id}")
+            os.replace(part_path, os.path.join(self.model_dir, f"{model_id}.{model_type}.pt"))
+        self.get(model_id)
+        return model_id
+
+    def get(self, model_id: str):
+        """Returns the resident model, loading it from disk if needed.
+
+        Concurrent requests for a model that is being loaded wait for that load,
+        while other models stay available during it.
+        """
+        with self._lock:
+            if model_id in self._models:
+                self._models.move_to_end(model_id)
+                return self._models[model_id][0]
+            future = self._loading.get(model_id)
+            if future is None:
+                path, model_type = self._locate(model_id)
+                future = self._loading[model_id] = Future()
+                loader = True
+            else:
+                loader = False
+        if not loader:
+            return future.result()
+        try:
+            model = self._load(path, model_type)
+            size = _model_bytes(model)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[model_id]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[model_id]
+            self._models[model_id] = (model, size)
+            evicted = self._evict(keep=model_id)
+        future.set_result(model)
+        self._unloaded(evicted)
+        return model
+
+    def unload(self, model_id: str) -> bool:
+        with self._lock:
+            if self._models.pop(model_id, None) is None:
+                return False
+        self._unloaded([model_id])
+        return True
+
+    def _unloaded(self, model_ids: list):
+        if not model_ids:
+            return
+        _free_memory()
+        for model_id in model_ids:
+            print("unloaded", model_id)
+
+    def _evict(self, keep: str) -> list:
+        """Drops least recently used models until the budget is respected.
+
+        Called with the lock held, returns the ids of the dropped models.
+        """
+        evicted = []
+        if self.memory_budget is None:
+            return evicted
+        while self.resident_bytes() > self.memory_budget:
+            oldest = next(iter(self._models))
+            if oldest == keep:
+                break
+            del self._models[oldest]
+            evicted.append(oldest)
+        return evicted
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+    def describe(self) -> dict:
+        """Lists the resident and the known but unloaded models."""
+        with self._lock:
+            resident = {model_id: size for model_id, (_, size) in self._models.items()}
+        uploaded = [
+            os.path.basename(path).split(".")[0]
+            for path in glob.glob(os.path.join(self.model_dir, "*.*.pt"))
+        ]
+        return {
+            "resident": [
+                {"id": model_id, "mb": round(size / 2**20, 1)}
+                for model_id, size in resident.items()
+            ],
+            "available": sorted(set(self._configured) | set(uploaded)),
+            "resident_mb": round(sum(resident.values()) / 2**20, 1),
+            "budget_mb": round(self.memory_budget / 2**20, 1) if self.memory_budget else None,
+        }
+
+    def _load(self, model_path: str, model_type: str):
+        model = MODEL_CLASSES[model_type](model_path)
+        # 預熱: 第一次推論會初始化 CUDA context 與 kernel
+        warmup = np.zeros((self.warmup_size, self.warmup_size, 3), np.uint8)
+        model(warmup, verbose=False)
+        print("loaded", model_path)
+        return model
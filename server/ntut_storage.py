@@ -0,0 +1,125 @@
+# -*- coding=utf-8 -*-
+# NTUT_2025 CV
+# 暫存檔管理: 請求產生的結果保存在記憶體中, 留在磁碟上的檔案由背景 janitor 依存活時間與容量清除
+import fnmatch
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class TTLStore:
+    """In-memory files that expire after `ttl` seconds or once `max_bytes` is exceeded.
+
+    Replaces the per-request output folders, so results that are fetched once right
+    after the request never touch the disk.
+    """
+
+    def __init__(self, ttl: float = 600, max_bytes: int = 64 << 20):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> (expires, data), oldest first
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            if key in self._items:
+                self._size -= len(self._items.pop(key)[1])
+            self._items[key] = (time.monotonic() + self.ttl, data)
+            self._size += len(data)
+            self._expire()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._expire()
+            item = self._items.get(key)
+            return item[1] if item else None
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._items:
+            key, (expires, data) = next(iter(self._items.items()))
+            if expires > now and self._size <= self.max_bytes:
+                break
+            del self._items[key]
+            self._size -= len(data)
+
+
+def _entry_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class Janitor:
+    """Background thread that bounds the age and size of server directories.
+
+    Each rule covers the top-level entries (files or folders) of a directory that
+    match a pattern. Entries older than `ttl` seconds are removed, then the oldest
+    ones until the rest fits in `max_mb`.
+    """
+
+    def __init__(self, interval: float = 600):
+        self.interval = interval
+        self._rules = []
+
+    def add(self, directory: str, pattern: str = "*", ttl: float = None, max_mb: float = None):
+        self._rules.append((directory, pattern, ttl, max_mb))
+
+    def sweep(self):
+        """Applies every rule once and returns the (entries, bytes) removed."""
+        removed = freed = 0
+        now = time.time()
+        for directory, pattern, ttl, max_mb in self._rules:
+            if not os.path.isdir(directory):
+                continue
+            entries = []
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if fnmatch.fnmatch(entry.name, pattern):
+                        try:
+                            mtime = entry.stat().st_mtime
+                            entries.append((mtime, entry.path, _entry_size(entry.path)))
+                        except OSError:
+                            continue  # removed while scanning
+            entries.sort()  # oldest first
+            total = sum(size for _, _, size in entries)
+            for mtime, path, size in entries:
+                expired = ttl is not None and now - mtime > ttl
+                too_big = max_mb is not None and total > max_mb * 2**20
+                if not (expired or too_big):
+                    continue
+                try:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+                freed += size
+        return removed, freed
+
+    def _run(self):
+        while True:
+            try:
+                removed, freed = self.sweep()
+                if removed:
+                    print(f"janitor: removed {removed} entries, {freed / 2**20:.1f} MB")
+            except Exception as e:
+                print("janitor:", e)
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self._run, name="janitor", daemon=True).start()
@@ -0,0 +1,274 @@
+####################################################################################
+#############################################################
+# -*- coding=utf-8 -*-
+__author__="ITRI-EOSL-R300 A30335-Rachel"
+# NTUT_2025 CV
+# env: teacher_cv
+# ps -ef | grep nsr
+# 單一推論伺服器: 同一個行程提供 YOLO 與 RT-DETR 等任意數量的 ultralytics 模型
+##############################################################
+from fastapi import FastAPI, UploadFile, File, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import uvicorn
+from datetime import datetime
+from ntut_batch_inf import decode_images, MicroBatcher, Overloaded, pack_detections, to_summaries, WIRE_CONTENT_TYPE
+from ntut_model_registry import ModelRegistry, guess_model_type
+from ntut_storage import TTLStore, Janitor
+from ntut_metrics import Histogram, render_values, memory_samples
+import time
+
+'''
+source deactivate
+pip install fastapi uvicorn
+pip install python-multipart
+'''
+
+app = FastAPI()
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(current_dir)
+print(root_dir)
+UPLOAD_DIR = os.path.join(root_dir, "API/uploads")
+OUTPUT_DIR = os.path.join(root_dir, "API/outputs")
+
+# 確保必要的目錄存在
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# 模型設定檔 (可選): 新增模型只需在 models.json 中加入一筆, 格式見 ModelRegistry
+MODELS_CONFIG = os.path.join(current_dir, "models.json")
+# 常駐模型的記憶體預算 (MB), 超過時卸載最久未使用的模型; None 表示不限制
+MODEL_MEMORY_BUDGET_MB = None
+# 模型以內容的 SHA-256 或設定檔中的名稱為 id, 多個模型可同時常駐
+MODELS = ModelRegistry(os.path.join(UPLOAD_DIR, "models"), config_path=MODELS_CONFIG, memory_budget_mb=MODEL_MEMORY_BUDGET_MB)
+# 合併同時送達的請求, 最多 BATCH_MAX_SIZE 張圖或等待 BATCH_MAX_WAIT 秒後一起推論
+BATCH_MAX_SIZE = 16
+BATCH_MAX_WAIT = 0.01
+# 等待推論的圖片上限, 超過時回傳 503 與 Retry-After, 讓用戶端稍後重試
+QUEUE_MAX_IMAGES = 256
+BATCHER = MicroBatcher(max_batch=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT, max_queue=QUEUE_MAX_IMAGES)
+# 影像解碼使用獨立且有上限的執行緒池, 不佔用事件迴圈與 FastAPI 的預設執行緒池
+DECODE_WORKERS = 4
+DECODE_POOL = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+# 服務的 port, 用戶端的 REMOTE_PORT 預設相同 (8070)
+PORT = int(os.getenv("PORT", "8070"))
+# 舊版 /upload-img/ 的結果只保存在本行程的記憶體中, 取回後 RESULT_TTL 秒內有效
+# 因此伺服器必須以單一行程執行 (不可使用 uvicorn --workers), 否則結果可能由別的行程取回而找不到
+RESULT_TTL = 600
+RESULTS = TTLStore(ttl=RESULT_TTL, max_bytes=64 << 20)
+# 背景清除: OUTPUT_DIR 中的舊檔案, 以及中斷的模型上傳
+OUTPUT_TTL = 24 * 3600
+OUTPUT_MAX_MB = 1024
+JANITOR = Janitor(interval=600)
+JANITOR.add(OUTPUT_DIR, ttl=OUTPUT_TTL, max_mb=OUTPUT_MAX_MB)
+JANITOR.add(MODELS.model_dir, pattern=".*.part", ttl=7 * 24 * 3600)
+JANITOR.add(MODELS.model_dir, pattern=".*.tmp", ttl=3600)
+
+DECODE_SECONDS = Histogram("ntut_decode_seconds", "Duration of decoding the images of a request", (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+# 設定檔中的模型預載完成後才算 ready
+READY = False
+
+def timed_decode(blobs: List[bytes]):
+    started = time.monotonic()
+    images = decode_images(blobs)
+    DECODE_SECONDS.observe(time.monotonic() - started)
+    return images
+
+async def infer(modelp: str, blobs: List[bytes]):
+    # 解碼與推論都在事件迴圈之外執行
+    loop = asyncio.get_running_loop()
+    images = await loop.run_in_executor(DECODE_POOL, timed_decode, blobs)
+    # 模型在此載入 (必要時), 批次執行緒只執行已載入的模型, 不會因載入而阻塞其他模型
+    model = await run_in_threadpool(MODELS.get, modelp)
+    return await asyncio.wrap_future(BATCHER.submit(modelp, model, images))
+
+def overloaded_response(e: Overloaded):
+    return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": str(e.retry_after)})
+
+@app.on_event("startup")
+async def preload_models():
+    global READY
+    JANITOR.start()
+    await run_in_threadpool(MODELS.preload)
+    READY = True
+
+@app.get("/healthz")
+async def healthz():
+    # 行程存活且推論執行緒仍在運作
+    if not BATCHER.alive():
+        return JSONResponse(status_code=503, content={"status": "inference worker stopped"})
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz(model: Optional[str] = None):
+    # 預載完成才可接受請求; 指定 model 時另外確認該模型已常駐, 未常駐則在此載入
+    # 只有檔案存在但無法載入的模型回報未就緒
+    if not READY or not BATCHER.alive():
+        return JSONResponse(status_code=503, content={"ready": False})
+    if model is not None:
+        try:
+            await run_in_threadpool(MODELS.get, model)
+        except KeyError:
+            return JSONResponse(status_code=503, content={"ready": False, "error": f"Unknown model: {model}"})
+        except Exception as e:
+            return JSONResponse(status_code=503, content={"ready": False, "error": f"Failed to load {model}: {e}"})
+    return {"ready": True}
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus 格式: 佇列深度, 批次大小, 解碼與推論延遲, 記憶體用量
+    stats = BATCHER.stats()
+    models = await run_in_threadpool(MODELS.describe)
+    lines = []
+    lines += render_values("gauge", "ntut_queue_images", "Images waiting for inference", [("", stats["queued_images"])])
+    lines += render_values("counter", "ntut_requests_total", "Completed inference requests", [("", stats["requests"])])
+    lines += render_values("counter", "ntut_images_total", "Images run through a model", [("", stats["images"])])
+    lines += render_values("counter", "ntut_errors_total", "Failed inference requests", [("", stats["errors"])])
+    lines += BATCHER.batch_images.render()
+    lines += BATCHER.inference_seconds.render()
+    lines += BATCHER.request_seconds.render()
+    lines += DECODE_SECONDS.render()
+    lines += render_values("gauge", "ntut_resident_models", "Models loaded in memory", [("", len(models["resident"]))])
+    lines += render_values("gauge", "ntut_resident_model_bytes", "Parameter memory of the loaded models", [("", await run_in_threadpool(MODELS.resident_bytes))])
+    lines += render_values("gauge", "ntut_memory_bytes", "Process resident memory and allocated GPU memory", await run_in_threadpool(memory_samples))
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.post("/upload-model/")
+def upload_model(file: UploadFile = File(...), model_type: Optional[str] = None):
+    # model_type 為 YOLO 或 RTDETR, 未指定時由檔名判斷
+    # 回傳的模型 id 即為之後請求中的 {modelp}
+    try:
+        model_id = MODELS.add(file.file, model_type or guess_model_type(file.filename))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    print(file.filename, model_id)
+    return model_id
+
+# 以 SHA-256 確認模型是否已存在, 只有不存在時才上傳, 大檔案分段上傳並可續傳:
+# GET 查詢 -> PUT 分段 (offset 為已收到的位元組數) -> POST complete 驗證並載入
+@app.get("/upload-model/{model_hash}")
+async def check_model(model_hash: str):
+    try:
+        cached = await run_in_threadpool(MODELS.has, model_hash)
+        return {"cached": cached, "offset": MODELS.received_bytes(model_hash)}
+    except KeyError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+@app.put("/upload-model/{model_hash}")
+async def upload_model_chunk(model_hash: str, request: Request, offset: int = 0):
+    data = await request.body()
+    try:
+        received = await run_in_threadpool(MODELS.append_chunk, model_hash, offset, data)
+    except KeyError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except ValueError as e:
+        # offset 不一致時回傳目前已收到的位元組數, 用戶端從該處續傳
+        return JSONResponse(status_code=409, content={"error": str(e), "offset": MODELS.received_bytes(model_hash)})
+    return {"offset": received}
+
+@app.post("/upload-model/{model_hash}/complete")
+def complete_model_upload(model_hash: str, model_type: Optional[str] = None, filename: str = ""):
+    try:
+        return MODELS.finish_upload(model_hash, model_type or guess_model_type(filename))
+    except (KeyError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+@app.post("/upload-img/{modelp}")
+async def upload_img(modelp: str, file: UploadFile = File(...)):
+    # 舊版用戶端: 單張圖片, summary 存於記憶體中再由 /download-image/ 取回, 不寫入磁碟
+    try:
+        # 建立唯一的輸出目錄名稱（使用檔案名稱去除副檔名）
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        filename_without_ext = os.path.splitext(file.filename)[0]
+        baseF = f'{timestamp}_{filename_without_ext}'
+        dst_folder_new = os.path.join(OUTPUT_DIR,baseF )
+
+        names, detections = await infer(modelp, [await file.read()])
+        summary_file_path = os.path.join(dst_folder_new, "summary.json")
+        RESULTS.put(f"{baseF}/summary.json", json.dumps(to_summaries(names, detections)[0]).encode("utf-8"))
+
+        # 回傳處理結果
+        return {
+            "message": "IMAGE 處理成功",
+            "filename": file.filename,
+            "processed_images": [],
+            "summary_file_path": summary_file_path,
+            "time_path": None,
+            "total_images": 0,
+            "OUTPUT_DIR2": dst_folder_new,
+            "baseF":baseF
+        }
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return {"error": str(e)}
+
+@app.post("/infer-batch/{modelp}")
+async def infer_batch(modelp: str, files: List[UploadFile] = File(...), format: str = "json"):
+    # 一次請求推論多張圖片, 影像在記憶體中解碼, 偵測結果直接放在回應中
+    # format=bin 時回傳二進位格式 (見 ntut_batch_inf), 否則為 JSON
+    try:
+        names, detections = await infer(modelp, [await f.read() for f in files])
+        if format == "bin":
+            return Response(pack_detections(names, detections), media_type=WIRE_CONTENT_TYPE)
+        return {"results": to_summaries(names, detections)}
+    except Overloaded as e:
+        return overloaded_response(e)
+    except KeyError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.get("/models")
+async def list_models():
+    # 常駐與可載入的模型, 以及記憶體使用量
+    return await run_in_threadpool(MODELS.describe)
+
+@app.post("/models/{modelp}/load")
+async def load_model(modelp: str):
+    try:
+        await run_in_threadpool(MODELS.get, modelp)
+    except KeyError as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    return await run_in_threadpool(MODELS.describe)
+
+@app.delete("/models/{modelp}")
+async def unload_model(modelp: str):
+    # 只卸載記憶體中的模型, 檔案保留, 下次請求時會重新載入
+    return {"unloaded": await run_in_threadpool(MODELS.unload, modelp)}
+
+@app.get("/stats")
+async def stats():
+    # 吞吐量與延遲 (p50/p99) 統計
+    return BATCHER.stats()
+
+@app.post("/cleanup")
+def cleanup():
+    # 立即執行一次清除
+    removed, freed = JANITOR.sweep()
+    return {"removed": removed, "freed_mb": round(freed / 2**20, 1)}
+
+@app.get("/download-image/{file_name}/{dir}")
+async def download_image(file_name: str, dir: str):
+    data = RESULTS.get(f"{dir}/{file_name}")
+    if data is not None:
+        return Response(data, media_type="application/json")
+    try:
+        if(dir):
+            image_path = os.path.join(os.path.join(OUTPUT_DIR, dir),file_name)
+        else:
+            image_path = os.path.join(OUTPUT_DIR,file_name)
+        print('-'*20,image_path )
+        return FileResponse(image_path)
+    except Exception as e:
+        return {"error": str(e)}
+
+if __name__ == "__main__":
+    # 單一行程: 結果 (RESULTS)、批次佇列與常駐模型都只存在於本行程
+    uvicorn.run(app, host="0.0.0.0", port=PORT)